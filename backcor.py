@@ -1,15 +1,43 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
 import numpy as np
 
-def backcor(n, y, order, threshold, fct='atq', mask=True):
+# numba (optional) is imported by _jit_update on the first fit with jit=True:
+# it takes longer to import than the rest of the module
+numba = None
+
+SOLVERS = ('pinv', 'chebyshev', 'legendre')
+MODELS = ('polynomial', 'pspline')
+ANDERSON_MEMORY = 5     # iterates used by the Anderson accelerator
+# MAX_ITER of the batch tools (removeBackgroundBatch, cube, service) unless
+# set: a fit that never reaches TOL (e.g. cycling between two estimations
+# with a truncated quadratic) stops there, not converged
+DEFAULT_MAX_ITER = 1000
+
+
+class FitCancelled(Exception):
+    '''
+    Raised from a backcor callback to abort the fit.
+    '''
+
+
+def backcor(n, y, order, threshold, fct='atq', mask=True, solver='pinv', full_output=False, callback=None,
+            a0=None, z0=None, tol=1e-9, max_iter=None, accelerate=None, stats=None,
+            model='polynomial', smoothness=1e-3, dtype=np.float64, jit=False, coarse=None):
     '''
     Background estimation by minimizing a non-quadratic cost function.
     
     [EST, COEFS, IT] = backcor(N, Y, ORDER, THRESHOLD, fcn=FUNCTION, index=True) computes an
     estimation EST of the background (aka. baseline) in a spectroscopic 
     signal Y with wavelength N.
-    The background is estimated by a polynomial with order ORDER using a 
-    cost-function FUNCTION with parameter THRESHOLD. FUNCTION can have the four
-    following values:
+    The background is estimated by a polynomial with order ORDER (or a
+    penalized spline, see MODEL) using a 
+    cost-function FUNCTION with parameter THRESHOLD. FUNCTION is the name of a
+    registered cost function (see CostFunction and register_cost); the four
+    built-in ones are:
         'sh'  - symmetric Huber function :  
             f(x) = { x^2  if abs(x) < THRESHOLD,
                    { 2*THRESHOLD*abs(x)-THRESHOLD^2  otherwise.
@@ -25,9 +53,70 @@ def backcor(n, y, order, threshold, fct='atq', mask=True):
     mask relate to a mask to put on point for for calculation of cost function
           if True, all elements are valid
           else for exemple [0, 0, 1, 1, 1, 0, 0] only elements 2-4 are valid
+    solver selects the polynomial basis used for the least-squares projection:
+        'pinv'      - monomial Vandermonde matrix, pseudo-inverse of T'T
+                      (original algorithm)
+        'chebyshev' - QR-factorized Chebyshev basis on the rescaled [-1, 1] axis
+        'legendre'  - QR-factorized Legendre basis on the rescaled [-1, 1] axis
+          The orthogonal bases stay well conditioned at high orders (20+).
+          Projectors are kept in projector_cache, so fits repeated on the
+          same axis, mask and order skip this setup.
+    model selects the background model:
+        'polynomial' - polynomial of order ORDER (default)
+        'pspline'    - cubic B-splines on ORDER uniform segments of the
+                       rescaled axis with a second-difference penalty of
+                       weight SMOOTHNESS on the coefficients (P-splines).
+                       Each iteration costs O(N), with memory linear in N,
+                       which suits long spectra with a slowly varying
+                       baseline. SOLVER is ignored.
+    full_output if True, a fourth output INFO is returned.
+    callback if given, is called as CALLBACK(IT, CHANGE) after each iteration
+          with the iteration number and the relative change of the estimation.
+          It may raise FitCancelled to abort the fit.
+    a0 warm-starts the iterations from the coefficients COEFS of a previous
+          call with the same ORDER and SOLVER (e.g. another THRESHOLD or FCT
+          on the same data) instead of the least-squares estimation.
+    z0 warm-starts the iterations from a background estimation on N, in the
+          units of Y (e.g. EST of a previous call on a similar spectrum).
+    tol is the relative change of the estimation below which the fit has
+          converged.
+    max_iter if given, bounds the number of iterations.
+    accelerate selects a convergence accelerator for the iterations on the
+          coefficients: None (plain fixed-point iteration) or 'anderson'
+          (Anderson extrapolation over the last ANDERSON_MEMORY iterates).
+    stats if given, a FitStats instance filled with the phase timings, the
+          convergence history and the number of points in each branch of the
+          cost function at each iteration. Nothing is recorded without it.
+    dtype of the iterations: np.float64 (default) or np.float32, which halves
+          the memory of the projector and of the iteration buffers of long
+          spectra at the cost of precision (keep TOL above ~1e-12). The
+          background and COEFS are returned in float64.
+    jit if True, the residuals and the auxiliary variable d are computed by
+          a numba-compiled loop (releasing the GIL) when numba is installed,
+          and by the NumPy kernel otherwise. INFO['kernel'] tells which ran.
+    coarse if given, the fit first runs on about COARSE of the valid points
+          (every k-th one, keeping the first and the last), and its
+          background is the warm start (see Z0) of the fit on all the
+          points, which then only needs a few iterations. TOL applies to
+          both, so the background agrees with the fit from scratch only as
+          far as TOL stops both near the same minimum: at the default TOL,
+          to about 1e-3 of the range of Y, for the same cost. Only used with a convex cost function ('sh', 'ah'):
+          with the truncated quadratics the warm start can end in another
+          local minimum, slower and with a higher cost. Ignored as well
+          when A0 or Z0 is given or when there are fewer than 2*COARSE
+          valid points. INFO['coarse_iterations'] is the number of
+          iterations of the first fit (0 when it did not run).
 
-   COEFS returns the ORDER+1 vector of the estimated polynomial coefficients.
+   COEFS returns the ORDER+1 vector of the estimated polynomial coefficients,
+         expressed in the basis of SOLVER on the rescaled axis (ORDER+3
+         B-spline coefficients for 'pspline').
    IT returns the number of iterations.
+   INFO is a dict with the solver (or 'pspline'), the condition number of
+        the basis (or normal) matrix ('cond') and the time spent building the projector
+        ('setup_time') and iterating ('iteration_time'), in seconds,
+        whether the fit converged within MAX_ITER ('converged'), the kernel of
+        the iterations ('numpy' or 'numba') and the ranges of N and Y of the valid points ('xlim', 'ylim') that map
+        COEFS back to the units of N and Y (see evaluate).
 
     For more informations, see:
         - V. Mazet, C. Carteret, D. Brie, J. Idier, B. Humbert. 
@@ -50,11 +139,20 @@ def backcor(n, y, order, threshold, fct='atq', mask=True):
 #    error('backcor:UnknownFunction','Unknown function.');
 #    end;
 
-    try:
-        if mask == True:
-            mask = np.ones((len(n), 1), dtype=bool)
-    except:
-        pass
+    tstart = time.perf_counter()
+    mask = _full_mask(n, mask)
+
+    # Coarse-to-fine: warm start from a fit on a decimated copy
+    coarse_it = 0
+    if coarse is not None and a0 is None and z0 is None and get_cost(fct).convex:
+        I = np.where(mask)[0]
+        k = len(I) // coarse
+        if k >= 2:
+            I = np.union1d(I[::k], I[[0, -1]])
+            z, a, coarse_it, info = backcor(n[I], y[I], order, threshold, fct, solver=solver, full_output=True,
+                                            callback=callback, tol=tol, max_iter=max_iter, accelerate=accelerate,
+                                            model=model, smoothness=smoothness, dtype=dtype, jit=jit)
+            z0 = evaluate(n, a, info['xlim'], info['ylim'], solver, model)
 
     #save n for output of background calculation at the end on the full x-axis
     n_initial = n
@@ -88,51 +186,64 @@ def backcor(n, y, order, threshold, fct='atq', mask=True):
     # Make column vectors
     N = len(n)
     n = n.reshape((N, 1))
-    y = y.reshape((N, 1))
+    y = y.reshape((N, 1)).astype(dtype)
             
-    # Vandermonde matrix
-    p = np.arange(order+1)
-    T = np.tile(n, (1, order+1)) ** np.tile(p, (N, 1))
-    Tinv = np.dot(np.linalg.pinv( np.dot(T.T,T) ), T.T)
-    
-    # Initialisation (least-squares estimation)
-    a = np.dot(Tinv, y)
-    z = np.dot(T, a)
+    # Basis matrix and least-squares projector
+    t0 = time.perf_counter()
+    P = projector_cache.get(n, order, solver, model, smoothness, dtype)
+    t1 = time.perf_counter()
+
+    # Initialisation (least-squares estimation or warm start)
+    if z0 is not None:
+        z0 = np.asarray(z0, dtype=float).reshape(-1)[I][i]
+        a = P.project(((z0-maxy)/dely + 1).reshape((N, 1)).astype(dtype))
+    elif a0 is not None:
+        a = P.projection(np.asarray(a0, dtype=float).reshape((-1, 1))).astype(dtype)
+    else:
+        a = P.project(y)
 
     # Other variables
     alpha = 0.99 * 1/2      # Scale parameter alpha
     it = 0                  # Iteration number
-    zp = np.ones((N, 1))    # Previous estimation
+    kernel = _Kernel((N, 1), fct, alpha, dtype, jit)
+    buffers = (np.empty((N, 1), dtype), np.empty((N, 1), dtype))    # z and zp, swapped each iteration
+    zp = np.ones((N, 1), dtype)    # Previous estimation
+    z = P.evaluate(a, out=buffers[0])
+
+    if accelerate == 'anderson':
+        accelerator = _Anderson(ANDERSON_MEMORY)
+    elif accelerate is None:
+        accelerator = None
+    else:
+        raise ValueError("Unknown accelerator '%s'" % accelerate)
 
     # LEGEND
-    while sum((z-zp)**2)/sum(zp**2) > 1e-9:
+    change = float(kernel.change(z, zp)[0])
+    while change > tol:
+        if max_iter is not None and it >= max_iter:
+            break
 
         it = it + 1         # Iteration number
         zp = z              # Previous estimation
-        res = y - z         # Residual
-
-        # Estimate d
-        if fct == 'sh':
-            a1 = (abs(res)<threshold).astype(int)
-            a2 = (res<=-threshold).astype(int)
-            a3 = (res>=threshold).astype(int)
-            d = (res*(2*alpha-1)) * a1 + (-alpha*2*threshold-res) * a2 + (alpha*2*threshold-res) * a3
-        elif fct == 'ah':
-            a1 = (res<threshold).astype(int)
-            a2 = (res>=threshold).astype(int)
-            d = (res*(2*alpha-1)) * a1 + (alpha*2*threshold-res) * a2
-        elif fct == 'stq':
-            a1 = (abs(res)<threshold).astype(int)
-            a2 = (abs(res)>=threshold).astype(int)
-            d = (res*(2*alpha-1)) * a1 - res * a2
-        elif fct == 'atq':
-            a1 = (res<threshold).astype(int)
-            a2 = (res>=threshold).astype(int)
-            d = (res*(2*alpha-1)) * a1 - res * a2
+
+        # Residual and y + d (estimate of d)
+        yd = kernel.update(y, z, threshold)
 
         # Estimate z
-        a = np.dot(Tinv, (y+d))    # Polynomial coefficients a
-        z = np.dot(T, a)           # Polynomial
+        if accelerator is None:
+            a = P.project(yd)          # Polynomial coefficients a (projected)
+        else:
+            a = accelerator.update(a, P.project(yd), lambda c: cost(y - P.evaluate(c), threshold, fct))
+        z = P.evaluate(a, out=buffers[it % 2])    # Polynomial
+
+        change = float(kernel.change(z, zp)[0])
+        if callback is not None:
+            callback(it, change)
+        if stats is not None:
+            stats.record(it, change, _branch_counts(kernel.res, threshold, fct))
+    t2 = time.perf_counter()
+    converged = bool(change <= tol)
+    a = P.coefficients(np.asarray(a, dtype=float))
    
     #back to original x-axis
     # Rescale 
@@ -142,10 +253,7 @@ def backcor(n, y, order, threshold, fct='atq', mask=True):
     n_initial = (n_initial+rescale_offset) * rescale_factor + 1
     # Make column vectors
     n_initial = n_initial.reshape((N, 1))
-    # Vandermonde matrix
-    p = np.arange(order+1)
-    T = np.tile(n_initial, (1, order+1)) ** np.tile(p, (N, 1))
-    z = np.dot(T, a)           # Polynomial
+    z = P.evaluate_at(n_initial, a)    # Polynomial
     # Rescaling back to original
     j =  np.argsort(i)
     z = (z[j]-1)*dely + maxy 
@@ -157,4 +265,982 @@ def backcor(n, y, order, threshold, fct='atq', mask=True):
     #z  Background
     #a  Polynomial coefficient
     #it Iteration number
+    if stats is not None:
+        stats.finish(it, converged, prepare=t0-tstart, projector=t1-t0, iterations=t2-t1,
+                     evaluation=time.perf_counter()-t2)
+    if full_output:
+        info = _info(P, kernel, t1-t0, t2-t1, converged, -rescale_offset-2/rescale_factor,
+                     -rescale_offset, maxy-2*dely, maxy)
+        info['coarse_iterations'] = coarse_it
+        return z, a, it, info
     return z, a, it
+
+
+def backcor_batch(n, y, order, threshold, fct='atq', mask=True, solver='pinv', full_output=False,
+                  a0=None, z0=None, tol=1e-9, max_iter=None, model='polynomial', smoothness=1e-3,
+                  dtype=np.float64, jit=False):
+    '''
+    Background estimation of many spectra sharing the same wavelength axis.
+
+    [EST, COEFS, IT] = backcor_batch(N, Y, ORDER, THRESHOLD, fct=FUNCTION, mask=True)
+    is the batched counterpart of backcor. Y is a 2-D array (spectra x points)
+    whose rows are all sampled on the wavelength axis N, and MASK is shared
+    by every spectrum. The Vandermonde matrix and its projector are built once
+    and the iterations run as a single matrix update over the whole batch.
+    Spectra that have converged drop out of the active set. SOLVER, MODEL,
+    SMOOTHNESS, DTYPE, JIT and FULL_OUTPUT are as in backcor. The warm starts A0 (spectra x ORDER+1,
+    or one coefficient vector for all spectra) and Z0 (spectra x points)
+    are as in backcor, one row per spectrum, and so are TOL and MAX_ITER.
+    INFO['converged'] and both bounds of INFO['ylim'] have one value per
+    spectrum.
+
+    EST returns the (spectra x points) backgrounds.
+    COEFS returns the (spectra x ORDER+1) polynomial coefficients.
+    IT returns the number of iterations of each spectrum.
+    '''
+    n = np.asarray(n)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    mask = _full_mask(n, mask)
+
+    #save n for output of background calculation at the end on the full x-axis
+    n_initial = n
+
+    #only keep valid points
+    I = np.where(mask)[0]
+    n = n[I]
+    y = y[:, I]
+
+    # Rescaling (one scale per spectrum, points along the first axis)
+    i = np.argsort(n)
+    n = n[i]
+    y = y[:, i].T
+
+    maxy = y.max(axis=0)
+    dely = (maxy-y.min(axis=0))/2
+    rescale_offset = -n[-1]
+    rescale_factor = 2 / (n[-1]-n[0])
+    n = (n+rescale_offset) * rescale_factor + 1
+    y = (y-maxy)/dely + 1
+    threshold = threshold / dely
+
+    # Make column vectors
+    N = len(n)
+    S = y.shape[1]
+    n = n.reshape((N, 1))
+    y = y.astype(dtype)
+
+    # Basis matrix and least-squares projector
+    t0 = time.perf_counter()
+    P = projector_cache.get(n, order, solver, model, smoothness, dtype)
+    t1 = time.perf_counter()
+
+    # Initialisation (least-squares estimation or warm start)
+    if z0 is not None:
+        z0 = np.atleast_2d(np.asarray(z0, dtype=float))[:, I][:, i].T
+        a = P.project(((z0-maxy)/dely + 1).astype(dtype))
+    elif a0 is not None:
+        a0 = np.atleast_2d(np.asarray(a0, dtype=float)).reshape((-1, P.size)).T
+        a = P.projection(np.tile(a0, (1, S)) if a0.shape[1] == 1 else a0).astype(dtype)
+    else:
+        a = P.project(y)
+    z = P.evaluate(a)
+
+    # Other variables
+    alpha = 0.99 * 1/2          # Scale parameter alpha
+    it = np.zeros(S, dtype=int) # Iteration number of each spectrum
+    zp = np.ones((N, S), dtype) # Previous estimation
+    kernel = _Kernel((N, S), fct, alpha, dtype, jit)
+
+    # Spectra still iterating
+    # a change that is not a number (flat spectrum, dely == 0) stops the
+    # spectrum unconverged, as in backcor
+    change = kernel.change(z, zp)
+    converged = change <= tol
+    active = np.where(change > tol)[0]
+    if max_iter is not None and max_iter <= 0:
+        active = active[:0]
+    while active.size:
+
+        it[active] += 1
+        zp = z[:, active]
+
+        # Residual and y + d (estimate of d)
+        yd = kernel.update(y[:, active], zp, threshold[active])
+
+        # Estimate z
+        a[:, active] = P.project(yd)
+        z[:, active] = P.evaluate(a[:, active])
+
+        change = kernel.change(z[:, active], zp)
+        converged[active] = change <= tol
+        active = active[change > tol]
+        if max_iter is not None:
+            active = active[it[active] < max_iter]
+    t2 = time.perf_counter()
+    a = P.coefficients(np.asarray(a, dtype=float))
+
+    #back to original x-axis
+    # Rescale
+    N = len(n_initial)
+    i =  np.argsort(n_initial)
+    n_initial = n_initial[i]
+    n_initial = (n_initial+rescale_offset) * rescale_factor + 1
+    # Make column vectors
+    n_initial = n_initial.reshape((N, 1))
+    z = P.evaluate_at(n_initial, a)
+    # Rescaling back to original
+    j =  np.argsort(i)
+    z = (z[j]-1)*dely + maxy
+
+    if full_output:
+        return z.T, a.T, it, _info(P, kernel, t1-t0, t2-t1, converged, -rescale_offset-2/rescale_factor,
+                                    -rescale_offset, maxy-2*dely, maxy)
+    return z.T, a.T, it
+
+
+def evaluate(n, coefs, xlim, ylim, solver='pinv', model='polynomial', batch=False):
+    '''
+    Background of coefficients COEFS on a new wavelength axis N.
+
+    EST = evaluate(N, COEFS, XLIM, YLIM) evaluates the coefficients returned
+    by backcor (or, with BATCH, those returned by backcor_batch) at N
+    without refitting. XLIM and YLIM are INFO['xlim'] and INFO['ylim'] of the fit,
+    and SOLVER and MODEL must be those of the fit; for 'pspline' the number
+    of segments follows from the length of COEFS. N may extend beyond XLIM.
+    The polynomial bases are evaluated by Horner's scheme ('pinv') or
+    Clenshaw's recurrence ('chebyshev', 'legendre') and the B-splines
+    locally, so no basis matrix is built.
+
+    Without BATCH, COEFS is the coefficient vector of one fit (1-D, or a
+    column as returned by backcor) and EST has the shape of N. With BATCH,
+    COEFS is (spectra x coefficients) as returned by backcor_batch, even
+    with a single coefficient (order 0) or a single spectrum, YLIM holds
+    one value per spectrum and EST is (spectra x points).
+    '''
+    shape = np.shape(n)
+    coefs = np.asarray(coefs, dtype=float)
+    single = not batch
+    if batch and coefs.ndim != 2:
+        raise ValueError('batch coefficients must be (spectra x coefficients)')
+    if single and coefs.size != max(coefs.shape, default=0):
+        raise ValueError('coefficients of several spectra: use batch=True')
+    miny, maxy = (np.asarray(v, dtype=float) for v in ylim)
+    # Rescaling as in backcor
+    n = 2 * (np.asarray(n, dtype=float).reshape(-1) - xlim[1]) / (xlim[1] - xlim[0]) + 1
+    a = coefs.reshape((-1, 1)) if single else coefs.T
+    if model == 'polynomial':
+        z = _evaluate(n, a, solver)
+    elif model == 'pspline':
+        index, weights = _bspline(n, len(a) - 3)
+        z = _spline_value(index, weights, a)
+    else:
+        raise ValueError("Unknown model '%s', expected one of %s" % (model, ', '.join(MODELS)))
+    if single:
+        return ((z-1) * (maxy-miny)/2 + maxy).reshape(shape)
+    return ((z-1) * (maxy-miny)/2 + maxy).T
+
+
+def jsonable(value):
+    '''
+    VALUE (a fit option or an INFO entry) with arrays, tuples and numpy
+    scalars as lists and Python numbers, and types as dtype names, for
+    JSON or a stable repr.
+    '''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (tuple, list)):
+        return [jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, type):
+        return np.dtype(value).name
+    return value
+
+
+def cost(res, threshold, fct='atq'):
+    '''
+    Value of the cost function FCT with parameter THRESHOLD (see backcor)
+    summed over the residuals RES.
+    '''
+    return np.sum(get_cost(fct).value(np.asarray(res), threshold))
+
+
+class CostFunction(object):
+    '''
+    Cost function of backcor, selected by its NAME once registered with
+    register_cost.
+
+    DESCRIPTION is its name in the GUI. The functions receive residuals RES
+    of any shape (a column vector or points x spectra) and a THRESHOLD that
+    broadcasts against them (a scalar or one value per spectrum):
+        VALUE(RES, THRESHOLD)   cost of each residual
+        D(RES, THRESHOLD, ALPHA, OUT, MASK)
+                                auxiliary variable d of the half-quadratic
+                                minimisation, written into the buffer OUT
+                                (and returned); MASK is a boolean buffer of
+                                the shape of RES for intermediate results.
+                                Both are allocated once per fit, so D
+                                should not allocate arrays of its own.
+        BRANCHES(RES, THRESHOLD)
+                                optional, number of residuals in each branch
+                                (quadratic first), recorded by FitStats
+        SCALAR(R, T, ALPHA)     optional, d of a single residual, in the
+                                subset of Python that numba compiles; used
+                                by the compiled kernel (jit=True), which
+                                falls back to D without it
+    CONVEX tells that the cost has a single minimum, whatever the starting
+    point of the iterations (used by the coarse-to-fine mode of backcor).
+    '''
+    def __init__(self, name, description, value, d, branches=None, scalar=None, convex=False):
+        self.name = name
+        self.description = description
+        self.value = value
+        self.d = d
+        self.branches = branches
+        self.scalar = scalar
+        self.convex = convex
+        self._jit_kernel = None
+
+
+# registered cost functions by name, in the order of registration
+COST_FUNCTIONS = OrderedDict()
+
+
+def register_cost(cost_function):
+    '''
+    Make the CostFunction COST_FUNCTION available to backcor (and to the
+    GUI) under its name, replacing a function of the same name. Worker
+    processes (batch processing, cubes) must register it too, e.g. by
+    importing the module that registers it. Returns COST_FUNCTION.
+    '''
+    COST_FUNCTIONS[cost_function.name] = cost_function
+    return cost_function
+
+
+def get_cost(fct):
+    '''
+    Registered CostFunction named FCT.
+    '''
+    try:
+        return COST_FUNCTIONS[fct]
+    except (KeyError, TypeError):
+        raise ValueError("Unknown cost function '%s', expected one of %s" % (fct, ', '.join(COST_FUNCTIONS)))
+
+
+class FitStats(object):
+    '''
+    Telemetry of a backcor fit, filled when passed as its STATS argument.
+
+    timings     seconds spent in each phase: 'prepare' (mask and rescaling),
+                'projector' (basis and least-squares projector, or cache
+                lookup), 'iterations' and 'evaluation' (background on the
+                full axis)
+    history     relative change of the estimation after each iteration
+    branches    number of points in each branch of the cost function at each
+                iteration: (a1, a2, a3) for 'sh', (a1, a2) for the other
+                built-in functions, a1 being the quadratic branch (empty
+                for a cost function that does not count them)
+    iterations  number of iterations
+    converged   whether the relative change went below the tolerance
+    callback    if given, called as CALLBACK(IT, CHANGE, BRANCHES) after
+                each iteration
+    '''
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.timings = {}
+        self.history = []
+        self.branches = []
+        self.iterations = 0
+        self.converged = None
+
+    def record(self, it, change, branches):
+        self.history.append(change)
+        self.branches.append(branches)
+        if self.callback is not None:
+            self.callback(it, change, branches)
+
+    def finish(self, it, converged, **timings):
+        self.iterations = it
+        self.converged = converged
+        self.timings.update(timings)
+
+    def as_dict(self):
+        '''
+        Plain dict of the telemetry (e.g. to be logged as JSON).
+        '''
+        return {'iterations': self.iterations,
+                'converged': self.converged,
+                'timings': dict(self.timings),
+                'history': list(self.history),
+                'branches': [list(b) for b in self.branches]}
+
+
+class ProjectorCache(object):
+    '''
+    Least-recently-used cache of the least-squares projectors of backcor.
+
+    Entries are keyed by a hash of the rescaled axis of the valid points
+    (which accounts for the mask), the order, the solver and the model
+    (with its smoothness). The memory held by the cached matrices is
+    bounded by MAX_BYTES; the least recently used entries are evicted first.
+    '''
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, n, order, solver, model='polynomial', smoothness=None, dtype=np.float64):
+        '''
+        Return the projector (_PolynomialProjector or _SplineProjector) for
+        the rescaled axis N (column vector) with matrices of DTYPE, building
+        it on a miss.
+        '''
+        dtype = np.dtype(dtype)
+        if model == 'polynomial':
+            smoothness = None
+        elif model == 'pspline':
+            solver = None
+        else:
+            raise ValueError("Unknown model '%s', expected one of %s" % (model, ', '.join(MODELS)))
+        key = (hashlib.sha1(np.ascontiguousarray(n)).hexdigest(), len(n), order, solver,
+               model, smoothness, dtype.str)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        if model == 'polynomial':
+            entry = _PolynomialProjector(n, order, solver, dtype)
+        else:
+            entry = _SplineProjector(n, order, smoothness, dtype)
+        size = entry.nbytes
+
+        with self._lock:
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = entry
+                self.nbytes += size
+                while self.nbytes > self.max_bytes:
+                    _, old = self._entries.popitem(last=False)
+                    self.nbytes -= old.nbytes
+        return entry
+
+    def stats(self):
+        '''
+        Hit/miss counters and memory usage of the cache.
+        '''
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries),
+                    'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+projector_cache = ProjectorCache()
+
+
+def _basis(n, order, solver):
+    '''
+    Basis matrix (points x ORDER+1) of the polynomial on the rescaled axis N
+    (column vector) for the basis of SOLVER.
+    '''
+    if solver == 'pinv':
+        # Vandermonde matrix (built column by column)
+        return np.polynomial.polynomial.polyvander(n[:, 0], order)
+    elif solver == 'chebyshev':
+        return np.polynomial.chebyshev.chebvander(n[:, 0], order)
+    elif solver == 'legendre':
+        return np.polynomial.legendre.legvander(n[:, 0], order)
+    raise ValueError("Unknown solver '%s', expected one of %s" % (solver, ', '.join(SOLVERS)))
+
+
+def _evaluate(n, a, solver):
+    '''
+    Polynomial with coefficients A (ORDER+1 x spectra) in the basis of SOLVER
+    at the rescaled axis N, as a (points x spectra) array. Horner's scheme
+    and Clenshaw's recurrence only keep a few arrays of that size.
+    '''
+    n = np.reshape(n, (-1, 1))
+    if solver == 'pinv':
+        # Horner's scheme
+        z = np.empty((len(n), a.shape[1]))
+        z[:] = a[-1]
+        for c in a[-2::-1]:
+            z *= n
+            z += c
+        return z
+    elif solver == 'chebyshev':
+        return np.polynomial.chebyshev.chebval(n[:, 0], a, tensor=True).T
+    elif solver == 'legendre':
+        return np.polynomial.legendre.legval(n[:, 0], a, tensor=True).T
+    raise ValueError("Unknown solver '%s', expected one of %s" % (solver, ', '.join(SOLVERS)))
+
+
+def _bspline(n, segments):
+    '''
+    Segment index and the 4 non-zero cubic B-splines at the rescaled axis N
+    for SEGMENTS uniform segments on [-1, 1]. Points outside [-1, 1] use the
+    polynomial piece of the first or last segment.
+    '''
+    t = (np.ravel(n) + 1) / 2 * segments
+    index = np.clip(np.floor(t), 0, segments - 1).astype(int)
+    u = t - index
+    weights = np.empty((len(t), 4))
+    weights[:, 0] = (1-u)**3 / 6
+    weights[:, 1] = (3*u**3 - 6*u**2 + 4) / 6
+    weights[:, 2] = (-3*u**3 + 3*u**2 + 3*u + 1) / 6
+    weights[:, 3] = u**3 / 6
+    return index, weights
+
+
+def _banded_cholesky(band):
+    '''
+    Cholesky factor L of the symmetric positive definite matrix whose lower
+    band (bandwidth len(BAND)-1) is BAND, M[j+d, j] in BAND[d, j]; L is
+    stored the same way. O(K) for K columns.
+    '''
+    w, K = band.shape
+    L = np.zeros((w, K))
+    for j in range(K):
+        s = band[0, j] - sum(L[d, j-d]**2 for d in range(1, min(w, j+1)))
+        if s <= 0:
+            raise np.linalg.LinAlgError('Matrix is not positive definite')
+        L[0, j] = np.sqrt(s)
+        for i in range(j+1, min(j+w, K)):
+            # L[i, k] L[j, k] over the columns k < j within both bands
+            s = band[i-j, j] - sum(L[i-k, k] * L[j-k, k] for k in range(max(i-w+1, 0), j))
+            L[i-j, j] = s / L[0, j]
+    return L
+
+
+# rows of the diagonal blocks of a banded Cholesky factor inverted by _cholesky_blocks
+_BLOCK = 64
+
+
+def _cholesky_blocks(L, size=_BLOCK):
+    '''
+    The banded Cholesky factor L of _banded_cholesky as consecutive diagonal
+    blocks of SIZE rows: (first row, inverse of the block, coupling) of each
+    block, the coupling being the part of L left of the block (its first
+    rows against the last columns of the previous block). O(K SIZE) memory.
+    '''
+    w, K = L.shape
+    starts = list(range(0, K, size))
+    if len(starts) > 1 and K - starts[-1] < w - 1:
+        del starts[-1]      # each block spans the bandwidth of the next one
+    ends = starts[1:] + [K]
+    blocks = []
+    for start, end in zip(starts, ends):
+        rows = np.arange(start, end)
+        dense = np.zeros((end - start, end - start))
+        for d in range(w):
+            dense[np.arange(d, end - start), np.arange(end - start - d)] = L[d, start:end-d]
+        coupling = None
+        if start > 0:
+            columns = np.arange(start - w + 1, start)
+            offsets = rows[:w-1, None] - columns[None, :]
+            coupling = np.where(offsets < w, L[np.minimum(offsets, w - 1), columns[None, :]], 0.)
+        blocks.append((start, np.linalg.inv(dense), coupling))
+    return blocks
+
+
+def _banded_solve(blocks, b):
+    '''
+    Solution of (L L') x = B for the blocks of _cholesky_blocks and B (K x
+    spectra), by forward and back substitution one block at a time.
+    '''
+    x = np.empty(b.shape, np.result_type(b, blocks[0][1].dtype))
+    ends = [start for start, _, _ in blocks[1:]] + [len(b)]
+    for (start, inverse, coupling), end in zip(blocks, ends):
+        r = b[start:end].copy()
+        if coupling is not None:
+            w = coupling.shape[1]
+            r[:len(coupling)] -= np.dot(coupling, x[start-w:start])
+        x[start:end] = np.dot(inverse, r)
+    for k in range(len(blocks) - 1, -1, -1):
+        start, inverse, _ = blocks[k]
+        end = ends[k]
+        r = x[start:end].copy()
+        if k + 1 < len(blocks):
+            coupling = blocks[k+1][2]
+            r[-coupling.shape[1]:] -= np.dot(coupling.T, x[end:end+len(coupling)])
+        x[start:end] = np.dot(inverse.T, r)
+    return x.astype(b.dtype, copy=False)
+
+
+# largest banded matrix whose condition number is computed on its dense form
+_DENSE_COND = 256
+
+
+def _banded_cond(band, L, iterations=200):
+    '''
+    2-norm condition number of the symmetric positive definite matrix of
+    BAND (see _banded_cholesky), L its Cholesky factor: exact for at most
+    _DENSE_COND columns, otherwise estimated from its largest and smallest
+    eigenvalues by power and inverse power iterations.
+    '''
+    w, K = band.shape
+    if K <= _DENSE_COND:
+        M = np.zeros((K, K))
+        for d in range(w):
+            M[np.arange(d, K), np.arange(K-d)] = band[d, :K-d]
+            M[np.arange(K-d), np.arange(d, K)] = band[d, :K-d]
+        return np.linalg.cond(M)
+
+    def product(v):
+        out = band[0] * v
+        for d in range(1, w):
+            out[d:] += band[d, :K-d] * v[:K-d]
+            out[:K-d] += band[d, :K-d] * v[d:]
+        return out
+
+    blocks = _cholesky_blocks(L)
+    v = u = np.random.RandomState(0).rand(K) + 1
+    for i in range(iterations):
+        v = product(v)
+        largest = np.linalg.norm(v)
+        v /= largest
+        u = _banded_solve(blocks, u.reshape((-1, 1)))[:, 0]
+        smallest = 1 / np.linalg.norm(u)
+        u *= smallest
+    return largest / smallest
+
+
+def _spline_value(index, weights, c, out=None):
+    '''
+    Spline of B-spline coefficients C (coefficients x spectra) at the points
+    described by INDEX and WEIGHTS (see _bspline), as a (points x spectra)
+    array (written to OUT if given).
+    '''
+    if c.shape[1] == 1:
+        c = c[:, 0]
+        z = np.multiply(weights[:, 0], c.take(index), out=None if out is None else out[:, 0])
+        for k in range(1, 4):
+            z += weights[:, k] * c.take(index+k)
+        return z.reshape((-1, 1))
+    z = weights[:, 0:1] * c.take(index, axis=0)
+    for k in range(1, 4):
+        z += weights[:, k:k+1] * c.take(index+k, axis=0)
+    return z
+
+
+class _PolynomialProjector(object):
+    '''
+    Least-squares projector on the polynomial basis of SOLVER at the rescaled
+    axis N (column vector). The fit of v is evaluate(project(v)); project
+    returns the coefficients in the factorized basis (Q'v for the QR
+    solvers), converted to polynomial coefficients by coefficients(). The
+    matrices used by the iterations are stored in DTYPE.
+    '''
+    def __init__(self, n, order, solver, dtype=np.float64):
+        self.name = solver
+        self.order = order
+        self.size = order + 1
+        T = _basis(n, order, solver)
+        if solver == 'pinv':
+            self.Q, self.Qinv, self.R = T, np.dot(np.linalg.pinv( np.dot(T.T,T) ), T.T), None
+        else:
+            self.Q, self.R = np.linalg.qr(T)
+            self.Qinv = self.Q.T
+        self.Q = self.Q.astype(dtype, copy=False)
+        self.Qinv = np.ascontiguousarray(self.Qinv, dtype=dtype)
+        self._cond = None
+        self.nbytes = 0
+        for m in (self.Q, self.Qinv, self.R):
+            if m is not None:
+                m.flags.writeable = False
+                self.nbytes += m.nbytes
+
+    def project(self, v):
+        return np.dot(self.Qinv, v)
+
+    def evaluate(self, c, out=None):
+        if out is not None and (out.shape != (len(self.Q), c.shape[1]) or
+                                out.dtype != np.result_type(self.Q, c)):
+            out = None
+        return np.dot(self.Q, c, out=out)
+
+    def coefficients(self, c):
+        '''
+        Polynomial coefficients from the projection C.
+        '''
+        if self.R is None:
+            return c
+        return np.linalg.solve(self.R, c)
+
+    def projection(self, a):
+        '''
+        Inverse of coefficients: projection C of the polynomial coefficients A.
+        '''
+        if self.R is None:
+            return a
+        return np.dot(self.R, a)
+
+    def evaluate_at(self, n, a):
+        '''
+        Polynomial of coefficients A at the rescaled axis N (column vector).
+        '''
+        return _evaluate(n, a, self.name)
+
+    def cond(self):
+        '''
+        Condition number of the basis matrix, computed (an SVD) on the
+        first call only, so cached projectors do not pay for it again.
+        '''
+        if self._cond is None:
+            self._cond = np.linalg.cond(np.asarray(self.Q, dtype=float) if self.R is None else self.R)
+        return self._cond
+
+
+class _SplineProjector(object):
+    '''
+    Penalized least squares on cubic B-splines (P-splines, Eilers & Marx,
+    Statistical Science 11 (2), 1996) at the rescaled axis N (sorted column
+    vector). SEGMENTS uniform segments cover [-1, 1] and the second
+    differences of the SEGMENTS+3 coefficients are penalized with weight
+    SMOOTHNESS (scaled by the number of points per coefficient, so that it
+    does not depend on the sampling). Each point only sees 4 B-splines, so
+    B'v and Ba cost O(N); the normal matrix has bandwidth 3, only its band
+    is stored and factorized (Cholesky, once), and each projection solves
+    it in O(SEGMENTS).
+    '''
+    def __init__(self, n, segments, smoothness, dtype=np.float64):
+        if segments < 1:
+            raise ValueError('P-splines need at least one segment')
+        self.name = 'pspline'
+        self.segments = segments
+        self.size = segments + 3
+        N = len(n)
+        K = self.size
+        self.index, self.weights = _bspline(n, segments)
+
+        # first point of each non-empty segment (n is sorted)
+        starts = np.searchsorted(self.index, np.arange(segments))
+        counts = np.diff(np.append(starts, N))
+        self.segment = np.where(counts > 0)[0]
+        self.starts = starts[self.segment]
+
+        # band of B'B + second-difference penalty, M[j+d, j] in band[d, j]
+        self.band = np.zeros((4, K))
+        for k in range(4):
+            for l in range(k, 4):
+                self.band[l-k, self.segment+k] += np.add.reduceat(
+                    self.weights[:, k]*self.weights[:, l], self.starts)
+        penalty = smoothness * N / K
+        for d, value in enumerate((6., -4., 1.)):
+            self.band[d, :K-d] += penalty * value
+        # D'D of the second differences differs from the Toeplitz band at the ends
+        self.band[0, [0, K-1]] -= 5 * penalty
+        self.band[0, [1, K-2]] -= penalty
+        self.band[1, [0, K-2]] += 2 * penalty
+        self.L = _banded_cholesky(self.band)
+        self.blocks = [(start, inverse.astype(dtype), coupling if coupling is None else coupling.astype(dtype))
+                       for start, inverse, coupling in _cholesky_blocks(self.L)]
+        self._cond = None
+        self.weights = self.weights.astype(dtype)
+        self.nbytes = sum(m.nbytes for m in (self.index, self.weights, self.segment, self.starts,
+                                            self.band, self.L))
+        self.nbytes += sum(inverse.nbytes for _, inverse, _ in self.blocks)
+
+    def _transpose(self, v):
+        '''
+        B'v for a column vector or a (points x spectra) array V.
+        '''
+        out = np.zeros((self.size, v.shape[1]), v.dtype)
+        for k in range(4):
+            out[self.segment+k] += np.add.reduceat(self.weights[:, k:k+1]*v, self.starts, axis=0)
+        return out
+
+    def project(self, v):
+        return _banded_solve(self.blocks, self._transpose(v))
+
+    def evaluate(self, c, out=None):
+        return _spline_value(self.index, self.weights, c, out)
+
+    def coefficients(self, c):
+        return c
+
+    def projection(self, a):
+        return a
+
+    def evaluate_at(self, n, a):
+        index, weights = _bspline(n, self.segments)
+        return _spline_value(index, weights, a)
+
+    def cond(self):
+        '''
+        Condition number of the normal matrix: exact up to _DENSE_COND
+        coefficients, estimated by power iterations above.
+        '''
+        if self._cond is None:
+            self._cond = _banded_cond(self.band, self.L)
+        return self._cond
+
+
+def _info(P, kernel, setup_time, iteration_time, converged, xmin, xmax, ymin, ymax):
+    '''
+    Timing and conditioning report returned with full_output=True.
+    '''
+    return {'solver': P.name,
+            'kernel': kernel.name,
+            'cond': P.cond(),
+            'setup_time': setup_time,
+            'iteration_time': iteration_time,
+            'converged': converged,
+            'xlim': (xmin, xmax),
+            'ylim': (ymin, ymax)}
+
+
+class _Anderson(object):
+    '''
+    Safeguarded Anderson acceleration of the fixed-point iteration a -> G(a)
+    over the last MEMORY iterates. The extrapolated iterate is kept only if
+    it does not increase the cost function, otherwise the plain iterate is
+    used and the history restarts, so the cost still decreases at each
+    iteration as in the plain half-quadratic algorithm.
+    '''
+    def __init__(self, memory):
+        self.memory = memory
+        self.f = []     # residuals G(a)-a
+        self.g = []     # images G(a)
+
+    def update(self, a, g, objective):
+        '''
+        Next iterate from the current one A, its image G and the cost
+        function OBJECTIVE of the coefficients.
+        '''
+        self.f.append(g - a)
+        self.g.append(g)
+        if len(self.f) > self.memory + 1:
+            del self.f[0]
+            del self.g[0]
+        if len(self.f) < 2:
+            return g
+        dF = np.hstack([f1 - f0 for f0, f1 in zip(self.f[:-1], self.f[1:])])
+        dG = np.hstack([g1 - g0 for g0, g1 in zip(self.g[:-1], self.g[1:])])
+        gamma = np.linalg.lstsq(dF, self.f[-1], rcond=None)[0]
+        extrapolated = g - np.dot(dG, gamma)
+        if objective(extrapolated) <= objective(g):
+            return extrapolated
+        self.f = [self.f[-1]]
+        self.g = [g]
+        return g
+
+
+def _full_mask(n, mask):
+    '''
+    Expand MASK=True to a mask where every point of N is valid.
+    '''
+    try:
+        if mask == True:
+            mask = np.ones((len(n), 1), dtype=bool)
+    except:
+        pass
+    return mask
+
+
+def _branch_counts(res, threshold, fct):
+    '''
+    Number of residuals in each branch of the cost function FCT (see
+    FitStats), empty if it does not count them.
+    '''
+    branches = get_cost(fct).branches
+    if branches is None:
+        return ()
+    return tuple(int(n) for n in branches(res, threshold))
+
+
+class _Kernel(object):
+    '''
+    Residual and auxiliary variable d of the half-quadratic minimisation for
+    arrays of SHAPE (points x spectra), computed in buffers allocated once
+    per fit. update() overwrites the buffers, so its result is only valid
+    until the next call; res holds the residuals of the last update.
+    Spectra dropping out of backcor_batch use the leading columns.
+    '''
+    def __init__(self, shape, fct, alpha, dtype=np.float64, jit=False):
+        self.cost = get_cost(fct)
+        self.alpha = alpha
+        self._res = np.empty(shape, dtype)
+        self._yd = np.empty(shape, dtype)
+        self._mask = np.empty(shape, bool)
+        self._jit = _jit_update(self.cost) if jit else None
+        self.name = 'numpy' if self._jit is None else 'numba'
+        self.res = self._res
+
+    def update(self, y, z, threshold):
+        '''
+        y + d for the residuals y - z, THRESHOLD a scalar or one value per
+        spectrum (column).
+        '''
+        k = y.shape[1]
+        res, yd, mask = self._res[:, :k], self._yd[:, :k], self._mask[:, :k]
+        self.res = res
+        if self._jit is not None:
+            self._jit(y, z, np.broadcast_to(np.asarray(threshold, dtype=y.dtype), (k,)), self.alpha, res, yd)
+            return yd
+        np.subtract(y, z, out=res)
+        self.cost.d(res, threshold, self.alpha, yd, mask)
+        yd += y
+        return yd
+
+    def change(self, z, zp):
+        '''
+        Relative change between the estimations Z and ZP of each spectrum
+        (column). Uses the buffer of update(), whose result must be consumed.
+        '''
+        diff = np.subtract(z, zp, out=self._yd[:, :z.shape[1]])
+        return np.einsum('ij,ij->j', diff, diff) / np.einsum('ij,ij->j', zp, zp)
+
+
+def _jit_update(cost):
+    '''
+    numba-compiled update of _Kernel for the CostFunction COST (compiled on
+    first use), or None when numba is not installed or COST has no scalar
+    function.
+    '''
+    global numba
+    if cost.scalar is None:
+        return None
+    if numba is None:
+        try:
+            import numba
+        except ImportError:
+            return None
+    if cost._jit_kernel is None:
+        scalar = cost.scalar
+        if not numba.extending.is_jitted(scalar):
+            scalar = numba.njit(nogil=True)(scalar)
+
+        @numba.njit(nogil=True, cache=False)
+        def update(y, z, threshold, alpha, res, yd):
+            for j in range(y.shape[1]):
+                t = threshold[j]
+                for i in range(y.shape[0]):
+                    r = y[i, j] - z[i, j]
+                    res[i, j] = r
+                    yd[i, j] = y[i, j] + scalar(r, t, alpha)
+        cost._jit_kernel = update
+    return cost._jit_kernel
+
+
+def _estimate_d(res, threshold, fct, alpha, out=None, mask=None):
+    '''
+    Auxiliary variable d of the half-quadratic minimisation for the residual
+    RES. RES is a column vector or a (points x spectra) array, THRESHOLD a
+    scalar or one value per spectrum. OUT and MASK (a boolean array of the
+    shape of RES) are optional buffers.
+    '''
+    cost = get_cost(fct)
+    if out is None:
+        out = np.empty(res.shape, np.result_type(res.dtype, np.float32))
+    if mask is None:
+        mask = np.empty(res.shape, bool)
+    return cost.d(res, threshold, alpha, out, mask)
+
+
+# Built-in cost functions (see backcor)
+
+def _sh_value(res, threshold):
+    return np.where(abs(res)<threshold, res**2, 2*threshold*abs(res)-threshold**2)
+
+
+def _sh_d(res, threshold, alpha, out, mask):
+    np.greater_equal(res, threshold, out=mask)
+    d = np.multiply(res, 2*alpha-1, out=out)
+    np.subtract(alpha*2*threshold, res, out=d, where=mask)
+    np.less_equal(res, -threshold, out=mask)
+    np.subtract(-alpha*2*threshold, res, out=d, where=mask)
+    return d
+
+
+def _sh_branches(res, threshold):
+    return (np.count_nonzero(abs(res)<threshold),
+            np.count_nonzero(res<=-threshold),
+            np.count_nonzero(res>=threshold))
+
+
+def _sh_scalar(r, t, alpha):
+    if r <= -t:
+        return -2*alpha*t - r
+    elif r >= t:
+        return 2*alpha*t - r
+    return (2*alpha-1) * r
+
+
+def _ah_value(res, threshold):
+    return np.where(res<threshold, res**2, 2*threshold*res-threshold**2)
+
+
+def _ah_d(res, threshold, alpha, out, mask):
+    np.greater_equal(res, threshold, out=mask)
+    d = np.multiply(res, 2*alpha-1, out=out)
+    np.subtract(alpha*2*threshold, res, out=d, where=mask)
+    return d
+
+
+def _ah_scalar(r, t, alpha):
+    return 2*alpha*t - r if r >= t else (2*alpha-1) * r
+
+
+def _asymmetric_branches(res, threshold):
+    a1 = np.count_nonzero(res<threshold)
+    return (a1, res.size - a1)
+
+
+def _stq_value(res, threshold):
+    return np.where(abs(res)<threshold, res**2, threshold**2)
+
+
+def _stq_d(res, threshold, alpha, out, mask):
+    d = np.abs(res, out=out)
+    np.greater_equal(d, threshold, out=mask)
+    d = np.multiply(res, 2*alpha-1, out=out)
+    np.negative(res, out=d, where=mask)
+    return d
+
+
+def _stq_branches(res, threshold):
+    a1 = np.count_nonzero(abs(res)<threshold)
+    return (a1, res.size - a1)
+
+
+def _stq_scalar(r, t, alpha):
+    return -r if abs(r) >= t else (2*alpha-1) * r
+
+
+def _atq_value(res, threshold):
+    return np.where(res<threshold, res**2, threshold**2)
+
+
+def _atq_d(res, threshold, alpha, out, mask):
+    np.greater_equal(res, threshold, out=mask)
+    d = np.multiply(res, 2*alpha-1, out=out)
+    np.negative(res, out=d, where=mask)
+    return d
+
+
+def _atq_scalar(r, t, alpha):
+    return -r if r >= t else (2*alpha-1) * r
+
+
+register_cost(CostFunction('sh', 'symmetric Huber function', _sh_value, _sh_d, _sh_branches, _sh_scalar,
+                           convex=True))
+register_cost(CostFunction('ah', 'asymmetric Huber function', _ah_value, _ah_d, _asymmetric_branches, _ah_scalar,
+                           convex=True))
+register_cost(CostFunction('stq', 'symmetric truncated quadratic', _stq_value, _stq_d, _stq_branches, _stq_scalar))
+register_cost(CostFunction('atq', 'asymmetric truncated quadratic', _atq_value, _atq_d, _asymmetric_branches,
+                           _atq_scalar))
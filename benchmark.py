@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Benchmarks of backcor and of the .csv import/export
+
+* Synthetic spectra: polynomial baseline + Lorentzian/Gaussian peaks + noise
+* Fits timed across number of points, order, cost function, with and without mask
+* .csv load (csvData.loadCsv, used by the import dialog) and export timed separately
+* Start-up: import time of the modules that do not need Qt/matplotlib (each
+  in a new interpreter, which must not load the GUI libraries) and time to
+  the first window of the GUI, against IMPORT_BUDGET and STARTUP_BUDGET
+* Results are written as JSON, and two JSON files can be compared
+
+Example:
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+    python benchmark.py --sizes '' --csv-sizes '' --check (start-up only, fails over budget)
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import backcor
+from csvData import importCsvParameters, loadCsv, saveCsv
+
+FCTS = ('sh', 'ah', 'stq', 'atq')
+
+# modules usable without the GUI libraries
+CORE_MODULES = ('backcor', 'csvData', 'resultData', 'fitCache', 'workspace', 'sweep', 'stream', 'cube',
+                'service', 'removeBackgroundBatch')
+GUI_MODULES = ('PyQt4', 'sip', 'matplotlib')
+IMPORT_BUDGET = 0.3     # s, per core module
+STARTUP_BUDGET = 2.     # s, from the launch of removeBackgroundGUI.py to its first window
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+_IMPORT = '''
+import json, sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, sorted(m for m in %r if m in sys.modules)]))
+'''
+
+
+def synthetic_spectrum(n_points=1000, order=4, n_peaks=5, noise=0.01, seed=0):
+    """ Synthetic spectrum on [100, 1000]
+
+    Returns x, y and the true background (polynomial of the given order).
+    Peaks are alternately Lorentzian and Gaussian with random positions,
+    widths and heights; noise is gaussian with the given standard deviation
+    (relative to the highest peak).
+    """
+    rng = np.random.RandomState(seed)
+    x = np.linspace(100., 1000., n_points)
+    t = (x - 550.) / 450.
+    background = np.polynomial.polynomial.polyval(t, rng.uniform(-1., 1., order + 1))
+    y = background.copy()
+    for k in range(n_peaks):
+        center = rng.uniform(150., 950.)
+        width = rng.uniform(2., 20.)
+        height = rng.uniform(0.5, 2.)
+        if k % 2:
+            y += height * np.exp(-0.5 * ((x - center) / width) ** 2)
+        else:
+            y += height / (1. + ((x - center) / width) ** 2)
+    y += noise * 2. * rng.randn(n_points)
+    return x, y, background
+
+
+def best_time(function, repeat):
+    """ Best wall time of repeat calls, and the result of the last one
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def bench_fits(sizes, orders, repeat=3, threshold=0.05):
+    results = []
+    for n_points in sizes:
+        x, y, background = synthetic_spectrum(n_points)
+        mask = np.ones(n_points, dtype=bool)
+        mask[:n_points // 10] = False
+        for order in orders:
+            for fct in FCTS:
+                for masked in (False, True):
+                    def fit():
+                        backcor.projector_cache.clear()
+                        return backcor.backcor(x, y, order, threshold, fct, mask=mask if masked else True)
+                    elapsed, (z, a, it) = best_time(fit, repeat)
+                    results.append({'name': 'fit', 'n': n_points, 'order': order, 'fct': fct,
+                                    'masked': masked, 'time': elapsed, 'iterations': int(it),
+                                    'points_per_second': n_points / elapsed})
+    return results
+
+
+def bench_csv(sizes, repeat=3):
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        for n_points in sizes:
+            x, y, background = synthetic_spectrum(n_points)
+            path = os.path.join(directory, 'spectrum_%d.csv' % n_points)
+            elapsed, _ = best_time(lambda: saveCsv(path, x, y, header='x,y'), repeat)
+            results.append({'name': 'csv_export', 'n': n_points, 'time': elapsed,
+                            'points_per_second': n_points / elapsed,
+                            'bytes': os.path.getsize(path)})
+            parameters = importCsvParameters(headerValue=1)
+            for memoryMap in (False, True):
+                elapsed, _ = best_time(lambda: loadCsv(path, parameters, memoryMap=memoryMap), repeat)
+                results.append({'name': 'csv_load', 'n': n_points, 'memory_map': memoryMap, 'time': elapsed,
+                                'points_per_second': n_points / elapsed})
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_imports(modules=CORE_MODULES, repeat=3):
+    """ Import time of each module in a new interpreter, and the GUI modules it loads
+    """
+    results = []
+    for module in modules:
+        times = []
+        for i in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', _IMPORT % (module, GUI_MODULES)], cwd=HERE)
+            elapsed, loaded = json.loads(output.decode())
+            times.append(elapsed)
+        results.append({'name': 'import', 'module': module, 'time': min(times), 'budget': IMPORT_BUDGET,
+                        'gui_modules': loaded})
+    return results
+
+
+def bench_startup(repeat=3):
+    """ Time from the launch of the GUI to its first window (none without PyQt4)
+
+    Includes the start-up of the interpreter; needs a display.
+    """
+    if importlib.util.find_spec('PyQt4') is None:
+        return []
+    command = [sys.executable, os.path.join(HERE, 'removeBackgroundGUI.py'), '--quit-after-show']
+    elapsed, _ = best_time(lambda: subprocess.check_call(command, cwd=HERE), repeat)
+    return [{'name': 'gui_startup', 'time': elapsed, 'budget': STARTUP_BUDGET}]
+
+
+def over_budget(results):
+    """ Start-up results over their budget, or whose import loaded GUI modules
+    """
+    return [r for r in results if 'budget' in r and (r['time'] > r['budget'] or r.get('gui_modules'))]
+
+
+def run(sizes, orders, csv_sizes, repeat=3):
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'platform': platform.platform(),
+                     'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'repeat': repeat},
+            'results': (bench_fits(sizes, orders, repeat) + bench_csv(csv_sizes, repeat) +
+                        bench_imports(repeat=repeat) + bench_startup(repeat))}
+
+
+# measurements, not part of the identity of a benchmark
+_MEASURED = ('time', 'points_per_second', 'iterations', 'bytes', 'budget', 'gui_modules')
+
+
+def _key(result):
+    return tuple(sorted((k, v) for k, v in result.items() if k not in _MEASURED))
+
+
+def compare(old, new, stream=sys.stdout):
+    """ Print the time ratio new/old of every benchmark present in both runs
+    """
+    previous = dict((_key(r), r) for r in old['results'])
+    for result in new['results']:
+        before = previous.get(_key(result))
+        if before is None:
+            continue
+        label = ' '.join('%s=%s' % item for item in _key(result))
+        stream.write('%-70s %10.4f s -> %10.4f s  x%.2f\n' % (label, before['time'], result['time'],
+                                                            result['time'] / before['time']))
+
+
+def _ints(text):
+    return [int(v) for v in text.split(',') if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark backcor and the .csv import/export")
+    parser.add_argument("--sizes", default='1000,10000,100000', type=_ints, help="number of points of the fits")
+    parser.add_argument("--orders", default='2,6,20', type=_ints, help="polynomial orders of the fits")
+    parser.add_argument("--csv-sizes", default='10000,1000000', type=_ints, help="number of points of the .csv files")
+    parser.add_argument("--repeat", default=3, type=int, help="repetitions (best time is kept)")
+    parser.add_argument("--output", default=None, help="JSON file of the results (default: standard output)")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument("--check", action='store_true', help="exit with status 1 if the start-up is over budget")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.orders, args.csv_sizes, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results, sys.stderr)
+    failed = over_budget(results['results'])
+    for result in failed:
+        sys.stderr.write('over budget: %s %.3f s (budget %.3f s)%s\n' % (
+            result.get('module', result['name']), result['time'], result['budget'],
+            ', loads ' + ', '.join(result['gui_modules']) if result.get('gui_modules') else ''))
+    if args.check and failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Read and write .csv spectra without any GUI dependency
+
+* importCsvParameters: columns of the x and y-axis, header length
+* loadCsv: read x and y-axis from a .csv file
+* saveCsv: write x and y-axis to a .csv file
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import io
+import mmap
+import os
+
+import numpy as np
+
+
+class importCsvParameters():
+    def __init__(self, xIndex=1, yIndex=2, headerValue=0, filetype='csv'):
+        self.xIndex = xIndex  # column index of the x axis (1-based)
+        self.yIndex = yIndex  # column index of the y axis (1-based)
+        self.headerValue = headerValue  # number of lines of header
+        self.filetype = filetype
+
+    def __str__(self):
+        return self.filetype + chr(10) + "xIndex: " + str(self.xIndex) + chr(10) + "yIndex: " + str(self.yIndex) + chr(10) + "headerValue: " + str(self.headerValue)
+
+
+def loadCsv(filename, parameters=None, chunkSize=2**24, memoryMap=False):
+    """ Read the x and y columns of a .csv file as float arrays
+
+    The header lines (parameters.headerValue) are skipped and only the
+    columns parameters.xIndex and parameters.yIndex are parsed. The file is
+    read by blocks of about chunkSize bytes, so memory stays close to the
+    size of the two output arrays. With memoryMap, the file is mapped in
+    memory instead of being read through the file object.
+    """
+    if not parameters:
+        parameters = importCsvParameters()
+    columns = (parameters.xIndex-1, parameters.yIndex-1)
+
+    xChunks = []
+    yChunks = []
+    with open(filename, 'rb') as fileInput:
+        source = fileInput
+        if memoryMap and os.fstat(fileInput.fileno()).st_size:
+            source = mmap.mmap(fileInput.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for block in _iterBlocks(source, parameters.headerValue, chunkSize):
+                data = np.loadtxt(io.BytesIO(block), delimiter=',', usecols=columns, ndmin=2)
+                xChunks.append(data[:, 0])
+                yChunks.append(data[:, 1])
+        finally:
+            if source is not fileInput:
+                source.close()
+
+    if not xChunks:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate(xChunks), np.concatenate(yChunks)
+
+
+def _iterBlocks(source, headerValue, chunkSize):
+    """ Yield blocks of complete lines read from source (file or mmap), after the header
+    """
+    for i in range(headerValue):
+        source.readline()
+    tail = b''
+    while True:
+        block = source.read(chunkSize)
+        if not block:
+            break
+        block = tail + block
+        end = block.rfind(b'\n') + 1
+        tail = block[end:]
+        if end:
+            yield block[:end]
+    if tail.strip():
+        yield tail
+
+
+def saveCsv(path, x, y, header=''):
+    """ Write x and y as two columns of a .csv file
+    """
+    np.savetxt(path, np.array([x, y]).transpose(), fmt='%1.7e', delimiter=',', header=header)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Background removal of hyperspectral cubes (rows x cols x wavelength)
+
+    python cube.py map.npy out/ --x axis.npy --order 6 --threshold 50 --jobs 4
+
+The cube (.npy) is memory-mapped and its pixel spectra are fitted by chunks
+with backcor.backcor_batch on a pool of processes. Each worker builds the
+projector of the wavelength axis once and reuses it for all its chunks.
+The output directory holds memory-mapped cubes background.npy and
+corrected.npy, the number of iterations of each pixel (iterations.npy) and
+the chunks already written (done.npy), so an interrupted run resumes where
+it stopped when started again with the same parameters.
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import backcor
+
+# output cubes
+OUTPUTS = ('background', 'corrected')
+
+
+def process_cube(path, output, order, threshold, fct='atq', x=None, chunk=256, jobs=None, restart=False,
+                 progress=None, **fit_options):
+    '''
+    Remove the background of every pixel spectrum of the cube at PATH
+    (rows x cols x wavelength .npy) into the directory OUTPUT.
+
+    X is the wavelength axis (default: the channel number). Spectra are
+    fitted CHUNK at a time on JOBS processes; fit_options are passed to
+    backcor.backcor_batch (e.g. mask, solver, max_iter:
+    backcor.DEFAULT_MAX_ITER by default, None for no limit; pixels stopped
+    there count as not converged). Chunks written by a previous run with the
+    same parameters are skipped, unless RESTART. PROGRESS, if given, is
+    called with (chunks done, chunks) as chunks complete.
+
+    Returns a summary dict (spectra, chunks, chunks skipped, spectra whose
+    fit did not converge, elapsed time and throughput).
+    '''
+    fit_options.setdefault('max_iter', backcor.DEFAULT_MAX_ITER)
+    cube = np.load(path, mmap_mode='r')
+    if cube.ndim != 3:
+        raise ValueError('%s is not a cube (rows x cols x wavelength)' % path)
+    spectra = cube.shape[0] * cube.shape[1]
+    x = np.arange(cube.shape[2], dtype=float) if x is None else np.asarray(x, dtype=float)
+    if len(x) != cube.shape[2]:
+        raise ValueError('the axis has %d points, the cube %d wavelengths' % (len(x), cube.shape[2]))
+    chunks = (spectra + chunk - 1) // chunk
+    parameters = {'cube': os.path.abspath(path), 'shape': list(cube.shape),
+                  'axis': hashlib.sha1(np.ascontiguousarray(x)).hexdigest(), 'order': order,
+                  'threshold': threshold, 'fct': fct, 'chunk': chunk,
+                  'fit_options': dict((k, backcor.jsonable(v)) for k, v in fit_options.items())}
+    del cube
+
+    done = _open_outputs(output, parameters, x, chunks, restart)
+    todo = [k for k in range(chunks) if not done[k]]
+    skipped = chunks - len(todo)
+
+    start = time.perf_counter()
+    unconverged = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(process_chunk, path, output, k, chunk, order, threshold, fct, fit_options)
+                   for k in todo]
+        for n, future in enumerate(futures):
+            k, failed = future.result()
+            # marked once its data is on disk
+            done[k] = True
+            done.flush()
+            unconverged += failed
+            if progress is not None:
+                progress(skipped + n + 1, chunks)
+    elapsed = time.perf_counter() - start
+    processed = min(len(todo) * chunk, spectra)
+    return {'spectra': spectra,
+            'chunks': chunks,
+            'skipped': skipped,
+            'unconverged': unconverged,
+            'elapsed': elapsed,
+            'spectra_per_second': processed / elapsed if elapsed else 0.}
+
+
+def process_chunk(path, output, k, chunk, order, threshold, fct, fit_options):
+    '''
+    Fit the spectra k*CHUNK ... (k+1)*CHUNK-1 (row-major pixel order) of the
+    cube at PATH and write them to the cubes of OUTPUT. Returns (k, number
+    of fits that did not converge).
+    '''
+    cube = np.load(path, mmap_mode='r')
+    rows, cols, points = cube.shape
+    y = cube.reshape((rows * cols, points))[k*chunk:(k+1)*chunk]
+    x = np.load(os.path.join(output, 'x.npy'))
+    z, a, it, info = backcor.backcor_batch(x, y, order, threshold, fct, full_output=True, **fit_options)
+
+    stop = k*chunk + len(y)
+    for name, data in (('background', z), ('corrected', y - z)):
+        out = np.load(os.path.join(output, name + '.npy'), mmap_mode='r+')
+        out.reshape((rows * cols, points))[k*chunk:stop] = data
+        out.flush()
+        del out
+    iterations = np.load(os.path.join(output, 'iterations.npy'), mmap_mode='r+')
+    iterations.reshape(-1)[k*chunk:stop] = it
+    iterations.flush()
+    return k, int(np.count_nonzero(~np.asarray(info['converged'])))
+
+
+def _open_outputs(output, parameters, x, chunks, restart):
+    '''
+    Create the output directory (or check that it belongs to the same run)
+    and return the memory-mapped done flags of the chunks.
+    '''
+    parameters_path = os.path.join(output, 'parameters.json')
+    if not restart and os.path.exists(parameters_path):
+        with open(parameters_path) as f:
+            previous = json.load(f)
+        if previous != parameters:
+            raise ValueError('%s holds the results of another run (use restart to overwrite it)' % output)
+        return np.load(os.path.join(output, 'done.npy'), mmap_mode='r+')
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    shape = tuple(parameters['shape'])
+    np.save(os.path.join(output, 'x.npy'), x)
+    for name in OUTPUTS:
+        np.lib.format.open_memmap(os.path.join(output, name + '.npy'), mode='w+',
+                                  dtype=float, shape=shape).flush()
+    np.lib.format.open_memmap(os.path.join(output, 'iterations.npy'), mode='w+',
+                              dtype=np.int32, shape=shape[:2]).flush()
+    done = np.lib.format.open_memmap(os.path.join(output, 'done.npy'), mode='w+', dtype=bool, shape=(chunks,))
+    done.flush()
+    # written last: a run interrupted before this point starts over
+    with open(parameters_path, 'w') as f:
+        json.dump(parameters, f)
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove background from a hyperspectral cube (.npy)")
+    parser.add_argument("cube", help="input cube, rows x cols x wavelength (.npy)")
+    parser.add_argument("output", help="output directory")
+    parser.add_argument("--x", default=None, help="wavelength axis (.npy, default: channel number)")
+    parser.add_argument("--order", default=6, type=int, help="order of the polynomial")
+    parser.add_argument("--threshold", default=50., type=float, help="threshold of the cost function")
+    parser.add_argument("--fct", default='atq', choices=list(backcor.COST_FUNCTIONS), help="cost function")
+    parser.add_argument("--max-iter", default=backcor.DEFAULT_MAX_ITER, type=int,
+                        help="maximum number of iterations per fit")
+    parser.add_argument("--chunk", default=256, type=int, help="spectra per chunk")
+    parser.add_argument("--restart", action='store_true', help="overwrite the results of a previous run")
+    parser.add_argument("-j", "--jobs", default=None, type=int, help="number of worker processes (default: all cpus)")
+    args = parser.parse_args(argv)
+
+    x = None if args.x is None else np.load(args.x)
+
+    def progress(done, chunks):
+        sys.stdout.write('\r%d/%d chunks' % (done, chunks))
+        sys.stdout.flush()
+
+    summary = process_cube(args.cube, args.output, args.order, args.threshold, args.fct, x=x, chunk=args.chunk,
+                           jobs=args.jobs, restart=args.restart, progress=progress, max_iter=args.max_iter)
+    sys.stdout.write('\n%d spectra, %d chunks (%d already done), %d not converged in %.3f s (%.0f spectra/s)\n' % (
+        summary['spectra'], summary['chunks'], summary['skipped'], summary['unconverged'], summary['elapsed'],
+        summary['spectra_per_second']))
+
+
+if __name__ == '__main__':
+    main()
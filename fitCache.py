@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Persistent cache of background fits
+
+* fitCache: directory of fit results keyed by a hash of the data (x, y,
+  mask) and of the fit parameters, with a size cap and least recently used
+  eviction
+* cachedBackcor: backcor.backcor through a fitCache
+* defaultCache: the cache shared by the GUI and the batch processing
+* openCache: the cache of a directory, one instance per process
+
+Each entry is an uncompressed .npz file (background, coefficients,
+iterations and the INFO dict of backcor as JSON), written atomically so
+that several processes can share a cache directory.
+
+    python fitCache.py [--clear] [directory]
+
+prints the size of a cache directory (default: the shared cache).
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import backcor
+
+# directory of the shared cache (overridden by $BACKCOR_CACHE)
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'backgroundRemoval')
+DEFAULT_MAX_BYTES = 512 * 2**20
+
+# backcor keywords left out of the key: they do not change the result of a
+# fit, except the warm start (a0, z0), whose fits are looked up but never
+# stored, so that every entry is a fit from scratch
+IGNORED_OPTIONS = ('callback', 'stats', 'full_output', 'a0', 'z0', 'jit')
+WARM_START_OPTIONS = ('a0', 'z0')
+
+
+class fitCache():
+    """ Directory of fit results, at most maxBytes in total
+
+    Entries are looked up by fitKey. The size of the directory is read
+    once, then kept up to date with the entries written by this instance;
+    when it exceeds maxBytes, the least recently used entries (by
+    modification time, refreshed on every hit) are removed down to
+    EVICT_TO * maxBytes and the size is read again, which also accounts
+    for the other processes sharing the directory. hits and misses count
+    the lookups of this instance.
+    """
+    # fraction of maxBytes left by an eviction, so that the directory is
+    # only listed again after that many bytes have been written
+    EVICT_TO = 0.9
+
+    def __init__(self, directory, maxBytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None           # bytes in the directory, None until listed
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """ (background, coefficients, iterations, info) of key, or None
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                result = (data['background'], data['coefficients'], int(data['iterations']),
+                          json.loads(str(data['info'])))
+            os.utime(path, None)
+        except (IOError, OSError, KeyError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key, background, coefficients, iterations, info):
+        """ Store a fit result under key, then evict entries if over maxBytes
+
+        The cache is best effort: a result that cannot be written is dropped.
+        """
+        info = dict((k, backcor.jsonable(v)) for k, v in info.items())
+        try:
+            handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, background=background, coefficients=coefficients, iterations=iterations,
+                         info=np.array(json.dumps(info)))
+            size = os.path.getsize(temporary)
+            try:
+                size -= os.path.getsize(self._path(key))
+            except OSError:
+                pass
+            os.replace(temporary, self._path(key))
+        except (IOError, OSError):
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            full = self._size is None or self._size > self.maxBytes
+        if full:
+            self.evict()
+
+    def entries(self):
+        """ (path, size, modification time) of every entry, oldest first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        entries.sort(key=lambda e: e[2])
+        return entries
+
+    def evict(self):
+        """ Remove the least recently used entries, down to EVICT_TO * maxBytes if over maxBytes
+        """
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        if size > self.maxBytes:
+            for path, n, _ in entries:
+                if size <= self.EVICT_TO * self.maxBytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= n
+        with self._lock:
+            self._size = size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = None
+
+    def stats(self):
+        """ Entries, size on disk and hit rate of the lookups of this instance
+        """
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {'entries': len(entries),
+                'bytes': sum(e[1] for e in entries),
+                'max_bytes': self.maxBytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.}
+
+
+def fitKey(n, y, order, threshold, fct='atq', mask=True, **options):
+    """ Hash of the data and of the parameters of a backcor fit
+    """
+    h = hashlib.sha1()
+    n = np.asarray(n, dtype=float)
+    for a in (n, np.asarray(y, dtype=float), np.ravel(backcor._full_mask(n, mask)).astype(bool)):
+        h.update(str(a.shape).encode())
+        h.update(np.ascontiguousarray(a))
+    options = dict((k, v) for k, v in options.items() if k not in IGNORED_OPTIONS)
+    h.update(repr((order, float(threshold), fct, sorted((k, backcor.jsonable(v)) for k, v in options.items()))).encode())
+    return h.hexdigest()
+
+
+def cachedBackcor(n, y, order, threshold, fct='atq', mask=True, cache=None, **options):
+    """ backcor.backcor(n, y, order, threshold, fct, mask, **options) through cache
+
+    cache defaults to defaultCache(). A hit returns the stored fit without
+    calling backcor (so callback is not called). A warm start (a0, z0) is
+    not part of the key: it may return the stored fit from scratch, but its
+    own result, which can depend on the starting point, is not stored.
+    """
+    cache = defaultCache() if cache is None else cache
+    key = fitKey(n, y, order, threshold, fct, mask, **options)
+    result = cache.get(key)
+    if result is None:
+        fullOutput = options.pop('full_output', False)
+        z, a, it, info = backcor.backcor(n, y, order, threshold, fct, mask=mask, full_output=True, **options)
+        if all(options.get(k) is None for k in WARM_START_OPTIONS):
+            cache.put(key, z, a, it, info)
+        result = (z, a, it, info)
+    else:
+        fullOutput = options.get('full_output', False)
+    return result if fullOutput else result[:3]
+
+
+_default = None
+_caches = {}
+
+
+def openCache(directory):
+    """ The fitCache of directory in this process, created on first use
+
+    Reusing one instance per directory keeps its running size, so that
+    processing many files does not list the directory again for each one.
+    """
+    directory = os.path.abspath(directory)
+    if directory not in _caches:
+        _caches[directory] = fitCache(directory)
+    return _caches[directory]
+
+
+def defaultCache():
+    """ The fitCache in $BACKCOR_CACHE (or DEFAULT_DIRECTORY), created on first use
+    """
+    global _default
+    if _default is None:
+        _default = fitCache(os.environ.get('BACKCOR_CACHE', DEFAULT_DIRECTORY))
+    return _default
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show or clear a cache of background fits")
+    parser.add_argument("directory", nargs='?', default=None, help="cache directory (default: the shared cache)")
+    parser.add_argument("--clear", action='store_true', help="remove every entry")
+    args = parser.parse_args(argv)
+
+    cache = defaultCache() if args.directory is None else fitCache(args.directory)
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    print('%s: %d entries, %.1f MB of %.1f MB' % (cache.directory, stats['entries'], stats['bytes'] / 2**20,
+                                                 stats['max_bytes'] / 2**20))
+
+
+if __name__ == '__main__':
+    main()
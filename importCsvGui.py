@@ -14,11 +14,14 @@ Last modified: 2016/12/02
 """
 
 import csv
-
-import sip
-sip.setapi('QString', 2)
-sip.setapi('QVariant', 2)
-
+import mmap
+import os
+from collections import OrderedDict
+
+# PyQt4 is imported here, as the classes below subclass its widgets; its
+# API v2 (QString as str, QVariant as Python objects) is the default on
+# Python 3, so sip.setapi is not called: this module is imported by
+# removeBackgroundGUI after PyQt4 is loaded, when the API can no longer be set
 from PyQt4 import QtGui, QtCore
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
@@ -26,6 +29,8 @@ from PyQt4.QtCore import *
 import argparse
 import numpy as np
 
+from csvData import importCsvParameters, loadCsv
+
 from PyQt4.QtGui import QDialog, QVBoxLayout, QDialogButtonBox, QDateTimeEdit, QApplication
 from PyQt4.QtCore import Qt, QDateTime
 
@@ -56,15 +61,147 @@ class importExternalData(QtGui.QWidget):
             print(parameters)
 
         
-class importCsvParameters():
-    def __init__(self, xIndex=1, yIndex=2, headerValue=0, filetype='csv'):
-        self.xIndex = xIndex  # column index of the x axis (1-based)
-        self.yIndex = yIndex  # column index of the y axis (1-based)
-        self.headerValue = headerValue  # number of lines of header
-        self.filetype = filetype
+class csvTableModel(QtCore.QAbstractTableModel):
+    """ Read-only table model serving the cells of a .csv file on demand
+
+    The file is memory-mapped and the byte offset of the start of each line
+    is indexed incrementally from a timer, so the view is usable before the
+    whole file is indexed. Only the rows actually displayed are parsed (and
+    kept in a small cache).
+    """
+    indexChunk = 2**22  # bytes indexed per timer tick
+    sampleRows = 100  # rows used to guess the number of columns
+    cacheRows = 1000  # parsed rows kept in memory
+
+    def __init__(self, parent=None):
+        super(csvTableModel, self).__init__(parent)
+        self.labels = {}
+        self._file = None
+        self._map = None
+        self._size = 0
+        self._starts = np.zeros(0, dtype=np.int64)  # byte offset of each line
+        self._rows = 0
+        self._columns = 0
+        self._indexed = 0  # bytes already indexed
+        self._cache = OrderedDict()
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._indexMore)
+
+    def openFile(self, filename):
+        self.beginResetModel()
+        self._release()
+        self._file = open(filename, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._starts = np.zeros(1024, dtype=np.int64)
+        # first block is indexed right away to fill the view
+        self._indexMore(notify=False)
+        self._columns = max([len(self._fields(row)) for row in range(min(self._rows, self.sampleRows))] or [0])
+        self.endResetModel()
+        if self._indexed < self._size:
+            self._timer.start(0)
+
+    def close(self):
+        self.beginResetModel()
+        self._release()
+        self.endResetModel()
+
+    def _release(self):
+        self._timer.stop()
+        self._rows = 0
+        self._columns = 0
+        self._indexed = 0
+        self._size = 0
+        self._cache.clear()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def isIndexed(self):
+        return self._indexed >= self._size
+
+    def setLabels(self, labels):
+        """ Horizontal header labels, as {column: label}
+        """
+        self.labels = labels
+        if self._columns:
+            self.headerDataChanged.emit(QtCore.Qt.Horizontal, 0, self._columns - 1)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self._rows
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self._columns
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+        fields = self._fields(index.row())
+        if index.column() < len(fields):
+            return fields[index.column()]
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole:
+            return None
+        if orientation == QtCore.Qt.Horizontal:
+            return self.labels.get(section, "")
+        return str(section + 1)
+
+    def _indexMore(self, notify=True):
+        """ Index the line starts of the next block of the file
+        """
+        if self._map is None:
+            self._timer.stop()
+            return
+        start = self._indexed
+        stop = min(start + self.indexChunk, self._size)
+        block = np.frombuffer(self._map, dtype=np.uint8, count=stop - start, offset=start)
+        starts = np.flatnonzero(block == 10) + start + 1
+        del block  # release the buffer so the map can be closed
+        starts = starts[starts < self._size]
+        if start == 0:
+            starts = np.concatenate(([0], starts))
+        self._indexed = stop
+        if self.isIndexed():
+            self._timer.stop()
+        if not len(starts):
+            return
+
+        first = self._rows
+        last = first + len(starts) - 1
+        if notify:
+            self.beginInsertRows(QtCore.QModelIndex(), first, last)
+        if last >= len(self._starts):
+            self._starts = np.resize(self._starts, max(2 * len(self._starts), last + 1))
+        self._starts[first:last + 1] = starts
+        self._rows = last + 1
+        if notify:
+            self.endInsertRows()
+
+    def _fields(self, row):
+        """ Fields of one line, parsed on first access
+        """
+        fields = self._cache.get(row)
+        if fields is None:
+            start = int(self._starts[row])
+            if row + 1 < self._rows:
+                end = int(self._starts[row + 1])
+            else:
+                end = self._map.find(b'\n', start)
+                if end < 0:
+                    end = self._size
+            line = self._map[start:end].decode('utf-8', 'replace').rstrip('\r\n')
+            fields = next(csv.reader([line]), [])
+            self._cache[row] = fields
+            if len(self._cache) > self.cacheRows:
+                self._cache.popitem(last=False)
+        return fields
 
-    def __str__(self):
-        return self.filetype + chr(10) + "xIndex: " + str(self.xIndex) + chr(10) + "yIndex: " + str(self.yIndex) + chr(10) + "headerValue: " + str(self.headerValue)
 
 class importCsv(QtGui.QDialog):    
     def __init__(self, filename=False, parameters=None, parent=None):
@@ -108,9 +245,8 @@ class importCsv(QtGui.QDialog):
         yaxis.addWidget(yaxis_label)
         yaxis.addWidget(self.yaxis)
         
-        self.model = QtGui.QStandardItemModel(self)
-        self.model.setHorizontalHeaderItem(self.parameters.xIndex - 1, QStandardItem("x"))
-        self.model.setHorizontalHeaderItem(self.parameters.yIndex - 1, QStandardItem("y"))
+        self.model = csvTableModel(self)
+        self.model.rowsInserted.connect(self.rows_indexed)
         
         self.tableView = QtGui.QTableView(self)
         self.tableView.setModel(self.model)
@@ -164,13 +300,8 @@ class importCsv(QtGui.QDialog):
         self.update()
 
     def update(self):
-        # Clear header
-        nColumns = self.model.columnCount()
-        for i in range(nColumns):
-            self.model.setHorizontalHeaderItem(i, QStandardItem(""))
         # Fill header with new values
-        self.model.setHorizontalHeaderItem(self.parameters.xIndex - 1, QStandardItem("x"))
-        self.model.setHorizontalHeaderItem(self.parameters.yIndex - 1, QStandardItem("y"))
+        self.model.setLabels({self.parameters.xIndex - 1: "x", self.parameters.yIndex - 1: "y"})
 
         if self.hasData:
             first_line = self.header.value()
@@ -185,16 +316,12 @@ class importCsv(QtGui.QDialog):
             itemSelection = QItemSelection(index1, index2)
             selectionModel.select(itemSelection, QItemSelectionModel.Rows | QItemSelectionModel.Select)
             
+    def rows_indexed(self, parent, first, last):
+        # extend the selection as the file is indexed
+        self.update()
+
     def loadCsv(self, filename):
-        with open(filename, "r") as fileInput:
-            i = 1
-            for row in csv.reader(fileInput):    
-                items = [
-                    QtGui.QStandardItem(field)
-                    for field in row
-                ]
-                self.model.appendRow(items)
-                i += 1
+        self.model.openFile(filename)
 
         self.hasData = True
         self.update()
@@ -203,36 +330,24 @@ class importCsv(QtGui.QDialog):
         self.yaxis.setMaximum(nColumn)
         
     def writeCsv(self):
-#        print("columns:")
-#        print("x: " + str(self.parameters.xIndex-1))
-#        print("y: " + str(self.parameters.yIndex-1))
-
-        first_line = self.header.value()
-        last_line = self.model.rowCount()
-#        print("rows:")
-#        print("first: " + str(first_line))
-#        print("last : " + str(last_line))
-
-        # Extract data to numpy arrays
-        # Far far from optimal
-        xArray = np.zeros([last_line-first_line,1 ])
-        yArray = np.zeros_like(xArray)
-        i = 0
-        for rowNumber in range(first_line, last_line):
-            x = self.model.data(self.model.index(rowNumber, self.parameters.xIndex-1),QtCore.Qt.DisplayRole)
-            y = self.model.data(self.model.index(rowNumber, self.parameters.yIndex-1),QtCore.Qt.DisplayRole)
-            xArray[i] = x
-            yArray[i] = y
-            i += 1
-        return np.squeeze(xArray), np.squeeze(yArray), self.parameters        
-
-    # static method to create the dialog and return (date, time, accepted)
+        """ Parse the x and y columns of the file straight into numpy arrays
+        """
+        x, y = loadCsv(self.filename, self.parameters, memoryMap=True)
+        return x, y, self.parameters
+
+    def done(self, result):
+        self.model.close()
+        super(importCsv, self).done(result)
+
+    # static method to create the dialog and return (x, y, parameters, accepted[, filename])
     @staticmethod
-    def getData(parent=None, parameters=None):
+    def getData(parent=None, parameters=None, withFilename=False):
         import numpy as np
         dialog = importCsv(parent, parameters=parameters)
         result = dialog.exec_()
         x, y, parameters = dialog.writeCsv()
+        if withFilename:
+            return (x, y, parameters, result == QDialog.Accepted, dialog.filename)
         return (x, y, parameters, result == QDialog.Accepted)
 
     @QtCore.pyqtSlot()
@@ -246,6 +361,7 @@ class importCsv(QtGui.QDialog):
                     "CSV (*.csv);;All Files (*)"))
         
         if path:
+            self.filename = path
             self.loadCsv(path)
             self.update()
 
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Remove background from many .csv files, without display
+
+* Select files with glob patterns and/or directories (all .csv inside)
+* Set Order, Threshold and fit method (same meaning as in the GUI)
+* Files are processed in parallel on a pool of processes
+* Corrected data is written next to each input as <name><suffix>.csv
+  (or .npz/.npy with --format, keeping background, coefficients and parameters)
+
+Example:
+    python removeBackgroundBatch.py data/ "runs/*.csv" --order 6 --threshold 50 --jobs 4
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import backcor
+import fitCache
+from csvData import importCsvParameters, loadCsv, saveCsv
+from resultData import saveResult
+
+
+def find_files(patterns, suffix='_corrected'):
+    """ Expand glob patterns and directories to a sorted list of input files
+
+    Files already produced by this tool (ending with suffix) are skipped,
+    unless suffix is empty.
+    """
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.csv')
+        files.update(f for f in glob.glob(pattern) if os.path.isfile(f))
+    return sorted(f for f in files if not (suffix and os.path.splitext(f)[0].endswith(suffix)))
+
+
+def output_path(path, suffix='_corrected', format='csv'):
+    root, ext = os.path.splitext(path)
+    if format != 'csv':
+        ext = '.' + format
+    return root + suffix + (ext or '.csv')
+
+
+def process_file(path, order, threshold, fct, parameters, suffix='_corrected', fit_options=None,
+                 telemetry=False, format='csv', cache=None):
+    """ Remove the background of one file
+
+    fit_options are passed to backcor.backcor (e.g. max_iter, accelerate, model).
+    cache is the directory of a fitCache ('' for the shared one) used unless
+    telemetry, or None to always fit.
+    Returns (path, number of points, error message or None, converged,
+    fit telemetry as a dict if telemetry else None, whether the fit came
+    from the cache).
+    """
+    stats = backcor.FitStats() if telemetry else None
+    cached = False
+    try:
+        x, y = loadCsv(path, parameters)
+        if cache is not None and not telemetry:
+            fits = fitCache.openCache(cache) if cache else fitCache.defaultCache()
+            hits = fits.hits
+            z, a, it, info = fitCache.cachedBackcor(x, y, order, threshold, fct, cache=fits, full_output=True,
+                                                    **(fit_options or {}))
+            cached = fits.hits > hits
+        else:
+            z, a, it, info = backcor.backcor(x, y, order, threshold, fct, full_output=True, stats=stats,
+                                             **(fit_options or {}))
+        if format == 'csv':
+            saveCsv(output_path(path, suffix), x, y-z, header=' > Background removed')
+        else:
+            saveResult(output_path(path, suffix, format), x, y, z, a,
+                       {'order': order, 'threshold': threshold, 'fct': fct, 'iterations': it,
+                        'model': (fit_options or {}).get('model', 'polynomial'), 'solver': info['solver'],
+                        'xlim': [float(v) for v in info['xlim']], 'ylim': [float(v) for v in info['ylim']]})
+        return path, len(x), None, info['converged'], stats and stats.as_dict(), cached
+    except Exception as e:
+        return path, 0, '%s: %s' % (type(e).__name__, e), False, None, False
+
+
+def process_files(files, order, threshold, fct='atq', parameters=None, suffix='_corrected', jobs=None,
+                  fit_options=None, telemetry=False, format='csv', cache=None):
+    """ Remove the background of every file on a pool of processes
+
+    Returns a summary dict (files, points, failures, files whose fit did not
+    converge, fits read from the cache, elapsed time and throughput, and
+    with telemetry the fit telemetry of each file).
+    """
+    if not parameters:
+        parameters = importCsvParameters()
+    failures = []
+    unconverged = []
+    fits = []
+    cached = 0
+    points = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(process_file, f, order, threshold, fct, parameters, suffix, fit_options, telemetry,
+                               format, cache)
+                   for f in files]
+        for future in futures:
+            path, n, error, converged, stats, hit = future.result()
+            points += n
+            cached += hit
+            if stats is not None:
+                stats['file'] = path
+                stats['points'] = n
+                fits.append(stats)
+            if error:
+                failures.append((path, error))
+            elif not converged:
+                unconverged.append(path)
+    elapsed = time.perf_counter() - start
+    return {'files': len(files),
+            'points': points,
+            'failures': failures,
+            'unconverged': unconverged,
+            'cached': cached,
+            'telemetry': fits,
+            'elapsed': elapsed,
+            'files_per_second': len(files) / elapsed if elapsed else 0.,
+            'points_per_second': points / elapsed if elapsed else 0.}
+
+
+def print_summary(summary, stream=sys.stdout):
+    for path, error in summary['failures']:
+        stream.write('FAILED %s (%s)\n' % (path, error))
+    for path in summary['unconverged']:
+        stream.write('NOT CONVERGED %s\n' % path)
+    stream.write('%d files, %d points, %d failures in %.3f s (%.1f files/s, %.0f points/s)\n' % (
+        summary['files'], summary['points'], len(summary['failures']), summary['elapsed'],
+        summary['files_per_second'], summary['points_per_second']))
+    if summary['cached']:
+        stream.write('%d of %d fits from the cache\n' % (summary['cached'], summary['files']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove background from .csv files")
+    parser.add_argument("inputs", nargs='+', help="input files, glob patterns or directories")
+    parser.add_argument("--order", default=6, type=int, help="order of the polynomial (segments of a P-spline)")
+    parser.add_argument("--threshold", default=50., type=float, help="threshold of the cost function")
+    parser.add_argument("--fct", default='atq', choices=list(backcor.COST_FUNCTIONS), help="cost function")
+    parser.add_argument("--model", default='polynomial', choices=backcor.MODELS, help="baseline model")
+    parser.add_argument("--smoothness", default=1e-3, type=float, help="penalty of the P-spline model")
+    parser.add_argument("--float32", action='store_true', help="iterate in single precision (less memory)")
+    parser.add_argument("--jit", action='store_true', help="use the numba-compiled kernel when numba is installed")
+    parser.add_argument("--coarse", default=None, type=int,
+                        help="first fit on about this many points, then refine on all of them "
+                             "(dense spectra; convex cost functions sh and ah only)")
+    parser.add_argument("--max-iter", default=backcor.DEFAULT_MAX_ITER, type=int,
+                        help="maximum number of iterations per fit")
+    parser.add_argument("--accelerate", default=None, choices=['anderson'], help="convergence accelerator")
+    parser.add_argument("--telemetry", default=None, help="write the telemetry of each fit to this file (JSON lines)")
+    parser.add_argument("--x", default=1, type=int, help="column of x-axis")
+    parser.add_argument("--y", default=2, type=int, help="column of y-axis")
+    parser.add_argument("--header", default=0, type=int, help="number of lines of header")
+    parser.add_argument("--format", default='csv', choices=['csv', 'npz', 'npy'], help="output format")
+    parser.add_argument("--suffix", default='_corrected', help="suffix of the output files")
+    parser.add_argument("--cache", nargs='?', const='', default=None,
+                        help="reuse identical fits from a cache directory (default: the shared cache)")
+    parser.add_argument("-j", "--jobs", default=None, type=int, help="number of worker processes (default: all cpus)")
+    args = parser.parse_args(argv)
+    if not args.suffix and args.format == 'csv':
+        parser.error('an empty --suffix would overwrite the input files')
+
+    parameters = importCsvParameters(xIndex=args.x, yIndex=args.y, headerValue=args.header, filetype='csv')
+    files = find_files(args.inputs, args.suffix)
+    fit_options = {'max_iter': args.max_iter, 'accelerate': args.accelerate,
+                   'model': args.model, 'smoothness': args.smoothness,
+                   'dtype': 'float32' if args.float32 else 'float64', 'jit': args.jit,
+                   'coarse': args.coarse}
+    summary = process_files(files, args.order, args.threshold, args.fct, parameters, args.suffix, args.jobs,
+                            fit_options, telemetry=bool(args.telemetry), format=args.format, cache=args.cache)
+    print_summary(summary)
+    if args.telemetry:
+        with open(args.telemetry, 'w') as f:
+            for stats in summary['telemetry']:
+                f.write(json.dumps(stats) + '\n')
+    return 1 if summary['failures'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
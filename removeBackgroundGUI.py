@@ -5,6 +5,11 @@ Remove background from dataset
 *     File > Load File
 *         OR
 *     Ctrl+L
+* Add more files (read with the same parameters, when shown)
+*     File > Add files
+*         OR
+*     Ctrl+Shift+O
+* Switch between spectra in the Spectra list
 * Set Order and Threshold parameters
 * Calculate Background
 *     File > Calculate Background
@@ -12,6 +17,12 @@ Remove background from dataset
 *     Ctrl+B
 *         OR
 *     Click "Background"
+* Calculate the background of every spectrum, in the background
+*     File > Fit all spectra
+*         OR
+*     Ctrl+Shift+B
+* Cancel Background
+*     Esc
 * Export data
 *     File > Export (.csv)
 *         OR
@@ -28,25 +39,304 @@ TODO
 grey calculate background, save image of export data if not possible
 display error message if background absent while saving
 add options for reading the csv file (header, etc)
-add generic interface for custom cost function
 """
 
 #import sys, os, random
+import os
 import sys
+import time
+from collections import OrderedDict
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
 import numpy as np
 
-import matplotlib
+import backcor
+import workspace
+# matplotlib, fitCache, sweep, csvData, resultData and importCsvGui are
+# imported where they are first needed, so that importing this module (for
+# decimate, cached_fit...) does not load them and the window shows up sooner.
+# Qt stays here: the widgets and workers below subclass its classes.
 
-from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
-#from matplotlib.backends.backend_qt4agg import NavigationToolbar2QTAgg as NavigationToolbar
-from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
-from matplotlib.figure import Figure
+def decimate(x, y, xmin, xmax, pixels):
+    """ Min/max decimation of a line for display
+
+    x must be sorted. Keeps the points of [xmin, xmax] (and one on each side)
+    and, when there are more than 4 per pixel, only the minimum and maximum
+    of y in each of the pixels bins, so the drawn envelope is unchanged.
+    """
+    start = max(np.searchsorted(x, xmin, 'left') - 1, 0)
+    stop = min(np.searchsorted(x, xmax, 'right') + 1, len(x))
+    x = x[start:stop]
+    y = y[start:stop]
+    n = len(x)
+    if n <= 4 * pixels:
+        return x, y
+    k = n // pixels
+    m = k * pixels
+    bins = y[:m].reshape(pixels, k)
+    offsets = np.arange(pixels) * k
+    index = np.concatenate((bins.argmin(axis=1) + offsets, bins.argmax(axis=1) + offsets, np.arange(m, n)))
+    index.sort()
+    return x[index], y[index]
+
+
+def fit_methods():
+    """ Fit Method names and backcor cost functions, from the registry of backcor
+
+    Cost functions registered with backcor.register_cost before the window
+    is created are listed with the built-in ones.
+    """
+    return OrderedDict((cost.description, cost.name) for cost in backcor.COST_FUNCTIONS.values())
+
+# Baseline model names and backcor models
+BASELINE_MODELS = OrderedDict([("polynomial", 'polynomial'),
+                               ("P-spline", 'pspline')])
+
+# largest relative change of the threshold for which a fit starts from the
+# last background (same fit method and model only): further away, the
+# warm start can end in another local minimum than a fit from scratch
+WARM_START_THRESHOLD = 0.2
+
+def cached_fit(x, y, parameters, callback=None, z0=None):
+    """ backcor.backcor with parameters (order, threshold, method, model, smoothness) through the shared fitCache
+
+    Returns ((z, a, it, info), whether the result came from the cache). A
+    fit started from z0 is not stored, the cache only holds fits from
+    scratch.
+    """
+    import fitCache
+    order, threshold, method, model, smoothness = parameters
+    cache = fitCache.defaultCache()
+    key = fitCache.fitKey(x, y, order, threshold, method, model=model, smoothness=smoothness)
+    result = cache.get(key)
+    if result is not None:
+        return result, True
+    result = backcor.backcor(x, y, order, threshold, method, callback=callback, z0=z0,
+                             model=model, smoothness=smoothness, full_output=True)
+    if z0 is None:
+        cache.put(key, *result)
+    return result, False
+
+
+class FitWorker(QThread):
+    """ Run backcor.backcor on a separate thread
+
+    progress is emitted with the iteration number and the relative change
+    (at most every progress_interval seconds), fitted with (z, a, it, info)
+    once done. Fits are looked up in (and, unless started from z0, added
+    to) the shared fitCache; cached tells whether the result came from it. A cancelled worker stops at its next iteration and emits nothing.
+    path is the workspace spectrum of x and y.
+    """
+    progress = pyqtSignal(int, float)
+    fitted = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    progress_interval = 0.05
+
+    def __init__(self, x, y, order, threshold, method, z0=None, parent=None,
+                 model='polynomial', smoothness=1e-3, path=None):
+        QThread.__init__(self, parent)
+        self.path = path
+        self.x = x
+        self.y = y
+        self.z0 = z0
+        self.parameters = (order, threshold, method, model, smoothness)
+        self.cached = False
+        self._cancelled = False
+        self._last_progress = 0.
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        try:
+            result, self.cached = cached_fit(self.x, self.y, self.parameters, self._progress, self.z0)
+        except backcor.FitCancelled:
+            return
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        if not self._cancelled:
+            self.fitted.emit(result)
+
+    def _progress(self, it, change):
+        if self._cancelled:
+            raise backcor.FitCancelled()
+        now = time.time()
+        if now - self._last_progress > self.progress_interval:
+            self._last_progress = now
+            self.progress.emit(it, change)
+
+
+class QueueWorker(QThread):
+    """ Fit spectra of a workspace one after the other on a separate thread
+
+    fitted is emitted with (path, (z, a, it, info)) for each spectrum,
+    progress with (spectra done, spectra) and failed with (path, message)
+    for a spectrum that cannot be read or fitted. Data are read through the
+    workspace (so they stay within its memory budget) and fits through the
+    shared fitCache. A cancelled worker stops at the next iteration.
+    """
+    fitted = pyqtSignal(str, object)
+    progress = pyqtSignal(int, int)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, workspace, paths, parameters, parent=None):
+        QThread.__init__(self, parent)
+        self.workspace = workspace
+        self.paths = paths
+        self.parameters = parameters
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        for k, path in enumerate(self.paths):
+            if self._cancelled:
+                return
+            try:
+                x, y = self.workspace.data(path)
+                result = cached_fit(x, y, self.parameters, self._check)[0]
+            except backcor.FitCancelled:
+                return
+            except Exception as e:
+                self.failed.emit(path, str(e))
+            else:
+                self.fitted.emit(path, result)
+            self.progress.emit(k + 1, len(self.paths))
+
+    def _check(self, it, change):
+        if self._cancelled:
+            raise backcor.FitCancelled()
+
+
+class SweepWorker(QThread):
+    """ Run sweep.sweep on a separate thread, fitted is emitted with (table, backgrounds)
+    """
+    fitted = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, x, y, orders, thresholds, methods, parent=None):
+        QThread.__init__(self, parent)
+        self.x = x
+        self.y = y
+        self.grid = (orders, thresholds, methods)
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        import sweep
+        try:
+            self.fitted.emit(sweep.sweep(self.x, self.y, *self.grid, return_backgrounds=True, callback=self._check))
+        except backcor.FitCancelled:
+            return
+        except Exception as e:
+            self.failed.emit(str(e))
+
+    def _check(self, it, change):
+        if self._cancelled:
+            raise backcor.FitCancelled()
+
+
+class SweepDialog(QDialog):
+    """ Fit a grid of Order/Threshold/Fit Method values and show thumbnails
+
+    Thumbnails are laid out with one column per threshold and one row per
+    (order, fit method). Clicking a thumbnail copies its parameters to the
+    main window.
+    """
+    def __init__(self, form):
+        QDialog.__init__(self, form)
+        self.form = form
+        self.worker = None
+        self.thumbnails = {}
+        self.setWindowTitle('Parameter sweep')
+        self.resize(900, 700)
+
+        self.orders = QLineEdit(form.order.text())
+        self.thresholds = QLineEdit(form.threshold.text())
+        self.methods = QLineEdit(form.current_fit_method())
+        grid = QFormLayout()
+        grid.addRow('Orders', self.orders)
+        grid.addRow('Thresholds', self.thresholds)
+        grid.addRow('Fit Methods (%s)' % ', '.join(fit_methods().values()), self.methods)
+
+        self.run_button = QPushButton("&Run")
+        self.connect(self.run_button, SIGNAL('clicked()'), self.run_sweep)
+
+        from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.figure import Figure
+        self.fig = Figure(dpi=form.dpi, tight_layout=True)
+        self.canvas = FigureCanvas(self.fig)
+        self.canvas.mpl_connect('button_press_event', self.on_click)
+        self.status = QLabel("Comma separated values, click a thumbnail to use its parameters")
+
+        vbox = QVBoxLayout()
+        vbox.addLayout(grid)
+        vbox.addWidget(self.run_button)
+        vbox.addWidget(self.canvas)
+        vbox.addWidget(self.status)
+        self.setLayout(vbox)
+
+    def run_sweep(self):
+        try:
+            orders = [int(v) for v in str(self.orders.text()).split(',') if v.strip()]
+            thresholds = [float(v) for v in str(self.thresholds.text()).split(',') if v.strip()]
+            methods = [v.strip() for v in str(self.methods.text()).split(',') if v.strip()]
+        except ValueError as e:
+            self.status.setText('Invalid values: %s' % e)
+            return
+        self.run_button.setEnabled(False)
+        self.status.setText('Fitting %d combinations...' % (len(orders) * len(thresholds) * len(methods)))
+        self.worker = SweepWorker(self.form.x, self.form.y, orders, thresholds, methods, self)
+        self.worker.fitted.connect(self.show_results)
+        self.worker.failed.connect(self.sweep_failed)
+        self.form.start_worker(self.worker)
+
+    def sweep_failed(self, message):
+        self.run_button.setEnabled(True)
+        self.status.setText('Sweep failed: %s' % message)
+
+    def show_results(self, result):
+        table, backgrounds = result
+        orders, thresholds, methods = self.worker.grid
+        self.run_button.setEnabled(True)
+        self.fig.clear()
+        self.thumbnails = {}
+        index = np.argsort(self.form.x, kind='mergesort')
+        x, y = self.form.x[index], self.form.y[index]
+        k = 0
+        for i, order in enumerate(orders):
+            for j, threshold in enumerate(thresholds):
+                for m, method in enumerate(methods):
+                    row = table[k]
+                    axes = self.fig.add_subplot(len(orders) * len(methods), len(thresholds),
+                                                (i * len(methods) + m) * len(thresholds) + j + 1)
+                    axes.plot(*decimate(x, y, x.min(), x.max(), 200), linestyle='', marker=',')
+                    axes.plot(*decimate(x, backgrounds[k][index], x.min(), x.max(), 200))
+                    axes.set_title('%d / %g / %s: %d it, cost %.3g' % (order, threshold, method, row['iterations'], row['cost']),
+                                   fontsize='small')
+                    axes.set_xticks([])
+                    axes.set_yticks([])
+                    self.thumbnails[axes] = row
+                    k += 1
+        self.status.setText('%d fits in %.3f s (sum of fit times)' % (len(table), table['time'].sum()))
+        self.canvas.draw()
+
+    def on_click(self, event):
+        row = self.thumbnails.get(event.inaxes)
+        if row is None:
+            return
+        self.form.order.setText(str(row['order']))
+        self.form.threshold.setText('%g' % row['threshold'])
+        index = self.form.fit_method.findData(row['fct'])
+        if index >= 0:
+            self.form.fit_method.setCurrentIndex(index)
+        self.status.setText('Using order %d, threshold %g, %s' % (row['order'], row['threshold'], row['fct']))
 
-import backcor
-from importCsvGui import importCsv
 
 class AppForm(QMainWindow):
     def __init__(self, parent=None):
@@ -64,6 +354,14 @@ class AppForm(QMainWindow):
         self.threshold.setText('50')
         self.has_background = False
         self.background_removed = False
+        self.worker = None
+        self.queue = None  # QueueWorker fitting the workspace
+        self.workers = set()  # running worker threads, including replaced or cancelled ones
+        self.fit_result = None  # (parameters, coefficients, iterations, info) of the last fit
+        self.workspace = workspace.workspace()
+        self.current = None  # path of the spectrum shown
+        self.import_parameters = None  # .csv parameters of the last file imported with the dialog
+        self._showing = False  # fields being set to the parameters of a spectrum
         #self.plot_data()
 
     def export_csv(self):
@@ -71,16 +369,32 @@ class AppForm(QMainWindow):
         if self.background_removed:
             header = header + ' > Background removed'
 
-        file_choices = "CSV (*.csv)|*.csv"
+        file_choices = "CSV (*.csv);;NumPy, compressed (*.npz);;NumPy, memory-mappable (*.npy)"
         
         path = str(QFileDialog.getSaveFileName(self, 
                         'Save file', '', 
                         file_choices))
         if path:
+            from csvData import saveCsv
+            from resultData import saveResult
 #            self.canvas.print_figure(path, dpi=self.dpi)
             self.statusBar().showMessage('Saved to %s' % path, 2000)
 
-            np.savetxt(path, np.array([self.x, self.y-self.background]).transpose(), fmt='%1.7e', delimiter=',', header=header)
+            if os.path.splitext(path)[1].lower() in ('.npy', '.npz'):
+                # binary formats keep the background, coefficients and fit parameters
+                coefficients = None
+                parameters = {}
+                if self.fit_result is not None:
+                    (order, threshold, method, model, smoothness), coefficients, it, info = self.fit_result
+                    parameters = {'order': order, 'threshold': threshold, 'fct': method, 'iterations': it,
+                                  'model': model, 'solver': info['solver'],
+                                  'xlim': [float(v) for v in info['xlim']],
+                                  'ylim': [float(v) for v in info['ylim']]}
+                    if model == 'pspline':
+                        parameters['smoothness'] = smoothness
+                saveResult(path, self.x, self.y, self.background, coefficients, parameters, compressed=True)
+            else:
+                saveCsv(path, self.x, self.y-self.background, header=header)
         
     def save_plot(self):
         file_choices = "PNG (*.png)|*.png"
@@ -93,13 +407,78 @@ class AppForm(QMainWindow):
             self.statusBar().showMessage('Saved to %s' % path, 2000)
     
     def load_csv(self):
-        self.x, self.y, parameters, ok = importCsv.getData()
+        from importCsvGui import importCsv
+        x, y, parameters, ok, path = importCsv.getData(withFilename=True)
         if ok:
-            print(parameters)
-            self.draw_button.setEnabled(True)
-            self.has_background = False
-            self.background_removed = False
-            self.plot_data()
+            self.import_parameters = parameters
+            self.workspace.add(path, parameters, x, y)
+            self.add_spectrum_item(path)
+
+    def add_files(self):
+        """ Add .csv files to the workspace, read when first shown or fitted
+
+        They are read with the parameters of the last file imported with the
+        import dialog (the default ones before that).
+        """
+        paths = [str(p) for p in QFileDialog.getOpenFileNames(self, 'Add files', '',
+                                                              "CSV (*.csv);;All Files (*)")]
+        for path in paths:
+            self.workspace.add(path, self.import_parameters)
+            self.add_spectrum_item(path, select=False)
+        if paths and self.current is None:
+            self.spectra.setCurrentItem(self.spectrum_items[paths[0]])
+
+    def add_spectrum_item(self, path, select=True):
+        item = self.spectrum_items.get(path)
+        if item is None:
+            item = QListWidgetItem(self.spectra)
+            item.setData(Qt.UserRole, path)
+            item.setToolTip(path)
+            self.spectrum_items[path] = item
+        self.update_spectrum_item(path)
+        if select:
+            if self.spectra.currentItem() is item:
+                self.show_spectrum(path)
+            else:
+                self.spectra.setCurrentItem(item)
+
+    def update_spectrum_item(self, path):
+        item = self.spectrum_items.get(path)
+        if item is None or path not in self.workspace:
+            return
+        entry = self.workspace[path]
+        text = entry.name
+        if entry.fit is not None:
+            order, threshold, method, model, smoothness = entry.fit[0]
+            text += '  [%d / %g / %s]' % (order, threshold, method)
+        item.setText(text)
+
+    def spectrum_selected(self, item, previous=None):
+        if item is not None:
+            self.show_spectrum(str(item.data(Qt.UserRole)))
+
+    def show_spectrum(self, path):
+        """ Show a spectrum of the workspace with its last background and fit parameters
+        """
+        pinned = self.workspace.pinned
+        self.workspace.pinned = path
+        try:
+            x, y = self.workspace.data(path)
+        except (IOError, OSError, ValueError) as e:
+            self.workspace.pinned = pinned
+            self.statusBar().showMessage('Cannot read %s: %s' % (path, e), 5000)
+            return
+        entry = self.workspace[path]
+        self.current = path
+        self.x, self.y, self.index = x, y, entry.index
+        self.background = entry.background
+        self.has_background = entry.background is not None
+        self.background_removed = False
+        self.fit_result = entry.fit
+        if entry.fit is not None:
+            self.set_fit_parameters(entry.fit[0])
+        self.draw_button.setEnabled(True)
+        self.plot_data()
             
     def on_about(self):
         msg = """ 
@@ -107,67 +486,287 @@ class AppForm(QMainWindow):
         
          * Import data (.csv): 
          *     File > Load File
+         *     File > Add files (more spectra)
          * Set Order and Threshold parameters
          * Calculate Background
          *     File > Calculate Background
+         *     File > Fit all spectra
          * Export data
          *     File > Export (.csv)
         """
         QMessageBox.about(self, "Basic usage", msg.strip())
     
+    def create_plot(self):
+        """ Create the persistent artists of both subplots
+        """
+        self.axes.set_title('Data')
+        self.axes.set_xticklabels([])
+        self.data_line, = self.axes.plot([], [], '.', label='data')
+        self.background_line, = self.axes.plot([], [], '', label='background')
+        self.difference_line, = self.axes2.plot([], [], '.', label='data - background')
+        self.plotted = None  # (x, y, background, difference) sorted along x
+        self.axes.callbacks.connect('xlim_changed', self.on_xlim_changed)
+        self.axes2.callbacks.connect('xlim_changed', self.on_xlim_changed)
+
     def plot_data(self):
-        """ Redraws the figure
+        """ Update the plotted data and background
+
+        Only the data of the existing lines is replaced. Each line holds the
+        min/max decimation of the data over the visible x-range (about two
+        points per pixel), recomputed when zooming or panning.
         """
-        self.axes.clear()        
-        self.axes.grid(self.grid_cb.isChecked())
+        i = self.index
+        x = self.x[i]
+        y = self.y[i]
+        background = difference = None
+        if self.has_background:
+            background = self.background[i]
+            difference = y - background
+        self.plotted = (x, y, background, difference)
 
-        self.axes.plot(self.x, self.y, '.', label='data')
         self.axes.set_xlim([np.min(self.x), np.max(self.x)])
         self.axes.set_ylim([np.min(self.y), np.max(self.y)])
-        self.axes.set_title('Data')
-        self.axes.set_xticklabels([])
-        
-        self.axes2.clear()        
+        self.background_line.set_visible(self.has_background)
+        self.difference_line.set_visible(self.has_background)
         if self.has_background:
             self.axes.set_title('Data & Background')
-            self.axes.plot(self.x,self.background,'', label='background')
-
-            z = self.y - self.background
-            self.axes2.grid(self.grid_cb.isChecked())
-            
-            self.axes2.plot(self.x, z, '.', label='data - background')
             self.axes2.set_xlim([np.min(self.x), np.max(self.x)])
-            self.axes2.set_ylim([np.min(z), np.max(z)])
+            self.axes2.set_ylim([np.min(difference), np.max(difference)])
             self.axes2.set_title('Difference')
             self.axes2.legend()
-            
+        else:
+            self.axes.set_title('Data')
+            self.axes2.set_title('')
+            legend = self.axes2.get_legend()
+            if legend is not None:
+                legend.remove()
+        self.update_lines(self.axes)
+        self.update_lines(self.axes2)
+
         self.axes.legend()
-        self.canvas.draw()
+        self.canvas.draw_idle()
+
+    def update_lines(self, axes):
+        """ Decimate the lines of axes to its current x-range
+        """
+        if self.plotted is None:
+            return
+        x, y, background, difference = self.plotted
+        xmin, xmax = axes.get_xlim()
+        pixels = max(int(axes.bbox.width), 1)
+        if axes is self.axes:
+            self.data_line.set_data(*decimate(x, y, xmin, xmax, pixels))
+            if background is not None:
+                self.background_line.set_data(*decimate(x, background, xmin, xmax, pixels))
+        elif difference is not None:
+            self.difference_line.set_data(*decimate(x, difference, xmin, xmax, pixels))
+
+    def on_xlim_changed(self, axes):
+        self.update_lines(axes)
+        self.canvas.draw_idle()
+
+    def on_grid_changed(self):
+        self.axes.grid(self.grid_cb.isChecked())
+        self.axes2.grid(self.grid_cb.isChecked())
+        self.canvas.draw_idle()
     
     def calculate_background(self):
-        """ Calculate the background
+        """ Calculate the background on a worker thread
+
+        A running fit of the current spectrum with the same parameters is
+        left alone; one with other parameters is cancelled and replaced (a
+        fit of another spectrum goes on). The fit starts from the last
+        background of the current data when warm_start allows it.
         """
-        # fit method
-        text = str(self.fit_method.currentText())
-        if text == "symmetric Huber function":
-            method = 'sh'
-        elif text == "asymmetric Huber function":
-            method = 'ah'
-        elif text == "symmetric truncated quadratic":
-            method = 'stq'
-        elif text == "asymmetric truncated quadratic":
-            method = 'atq'
-            
-        self.statusBar().showMessage('Calculating background...')  # problem here: it just make status bar to blink. Like it print this line after it make calculation
-        order = int(self.order.text())
-        threshold = float(self.threshold.text())
-        z, a, it = backcor.backcor(self.x, self.y, order, threshold, method)
-        self.statusBar().showMessage('')
-        self.has_background = True
-        self.background = z
-        self.plot_data()
+        parameters = self.fit_parameters()
+        if self.worker is not None and self.worker.isRunning() and self.worker.path == self.current:
+            if self.worker.parameters == parameters:
+                return
+            self.worker.cancel()
+
+        order, threshold, method, model, smoothness = parameters
+        z0 = self.background if self.warm_start(parameters) else None
+        self.worker = FitWorker(self.x, self.y, order, threshold, method, z0, self,
+                                model=model, smoothness=smoothness, path=self.current)
+        self.worker.progress.connect(self.fit_progress)
+        self.worker.fitted.connect(self.fit_done)
+        self.worker.failed.connect(self.fit_failed)
+        self.worker.finished.connect(self.fit_finished)
+        self.statusBar().showMessage('Calculating background...')
+        self.start_worker(self.worker)
+
+    def start_worker(self, worker):
+        """ Start a worker thread, kept in workers until it finishes (see closeEvent)
+        """
+        self.workers.add(worker)
+        worker.finished.connect(self.worker_finished)
+        worker.start()
+
+    def worker_finished(self):
+        self.workers.discard(self.sender())
+
+    def warm_start(self, parameters):
+        """ Whether a fit with parameters can start from the last background
+
+        Only when that background was fitted with the same fit method and
+        model, and a threshold within WARM_START_THRESHOLD (relative).
+        """
+        if not self.has_background or self.fit_result is None:
+            return False
+        order, threshold, method, model, smoothness = parameters
+        last = self.fit_result[0]
+        return (method == last[2] and model == last[3] and
+                abs(threshold - last[1]) <= WARM_START_THRESHOLD * abs(last[1]))
+
+    def fit_parameters(self):
+        """ (order, threshold, method, model, smoothness) of the fields
+        """
+        return (int(self.order.text()),
+                float(self.threshold.text()),
+                self.current_fit_method(),
+                BASELINE_MODELS[str(self.baseline_model.currentText())],
+                float(self.smoothness.text()))
+
+    def current_fit_method(self):
+        """ Name of the backcor cost function of the Fit Method field
+        """
+        return str(self.fit_method.itemData(self.fit_method.currentIndex()))
+
+    def set_fit_parameters(self, parameters):
+        """ Set the fields to (order, threshold, method, model, smoothness), without refitting
+        """
+        order, threshold, method, model, smoothness = parameters
+        self._showing = True
+        try:
+            # the model first, it sets the range of the order
+            self.baseline_model.setCurrentIndex(list(BASELINE_MODELS.values()).index(model))
+            self.order.setText(str(order))
+            self.threshold.setText('%g' % threshold)
+            self.fit_method.setCurrentIndex(self.fit_method.findData(method))
+            self.smoothness.setText('%g' % smoothness)
+        finally:
+            self._showing = False
+
+    def fit_all(self):
+        """ Fit every spectrum of the workspace with the current parameters, on a worker thread
+
+        Spectra already fitted with these parameters are skipped; a running
+        fit of the workspace is cancelled and replaced.
+        """
+        parameters = self.fit_parameters()
+        if self.queue is not None and self.queue.isRunning():
+            self.queue.cancel()
+        paths = [entry.path for entry in self.workspace if entry.fit is None or entry.fit[0] != parameters]
+        if not paths:
+            self.statusBar().showMessage('Every spectrum is fitted with these parameters', 2000)
+            return
+        self.queue = QueueWorker(self.workspace, paths, parameters, self)
+        self.queue.fitted.connect(self.queue_fitted)
+        self.queue.progress.connect(self.queue_progress)
+        self.queue.failed.connect(self.queue_failed)
+        self.queue.finished.connect(self.queue_finished)
+        self.statusBar().showMessage('Fitting %d spectra...' % len(paths))
+        self.start_worker(self.queue)
+
+    def queue_fitted(self, path, result):
+        z, a, it, info = result
+        self.workspace.setFit(path, z, (self.sender().parameters, a, it, info))
+        self.update_spectrum_item(path)
+        if path == self.current and not (self.worker is not None and self.worker.isRunning()
+                                         and self.worker.path == path):
+            # the fields are left as they are
+            entry = self.workspace[path]
+            self.has_background = True
+            self.background = entry.background
+            self.fit_result = entry.fit
+            self.plot_data()
+
+    def queue_progress(self, done, total):
+        if self.sender() is self.queue:
+            stats = self.workspace.stats()
+            self.statusBar().showMessage('Fitted %d of %d spectra (%d in memory, %.0f MB)' % (
+                done, total, stats['loaded'], stats['bytes'] / 2**20), 2000 if done == total else 0)
+
+    def queue_failed(self, path, message):
+        self.statusBar().showMessage('Background calculation of %s failed: %s' % (path, message), 5000)
+
+    def queue_finished(self):
+        queue = self.sender()
+        if queue is self.queue:
+            self.queue = None
+        queue.deleteLater()
+
+    def parameter_sweep(self):
+        """ Open the parameter sweep dialog on the current data
+        """
+        SweepDialog(self).show()
+
+    def cancel_background(self):
+        for worker in (self.worker, self.queue):
+            if worker is not None and worker.isRunning():
+                worker.cancel()
+                self.statusBar().showMessage('Background calculation cancelled', 2000)
+        self.worker = None
+        self.queue = None
+
+    def baseline_model_changed(self):
+        # P-splines use the Order field as their number of segments
+        model = BASELINE_MODELS[str(self.baseline_model.currentText())]
+        if model == 'pspline':
+            self.order_label.setText('Segments')
+            self.order.setValidator(QIntValidator(1, 9999, self))
+            self.order.setMaxLength(4)
+        else:
+            self.order_label.setText('Order')
+            self.order.setValidator(QIntValidator(0, 101, self))
+            self.order.setMaxLength(3)
+        self.smoothness.setEnabled(model == 'pspline')
+        self.parameters_changed()
+
+    def parameters_changed(self):
+        # replace a running fit of the current spectrum by one with the new parameters
+        if self._showing:
+            return
+        if self.worker is not None and self.worker.isRunning() and self.worker.path == self.current:
+            self.calculate_background()
+
+    def fit_progress(self, it, change):
+        if self.sender() is self.worker:
+            self.statusBar().showMessage('Calculating background... iteration %d, relative change %.2e' % (it, change))
+
+    def fit_done(self, result):
+        # kept with its spectrum, even if another one is shown by now
+        worker = self.sender()
+        z, a, it, info = result
+        self.workspace.setFit(worker.path, z, (worker.parameters, a, it, info))
+        self.update_spectrum_item(worker.path)
+        if worker is not self.worker:
+            return
+        import fitCache
+        stats = fitCache.defaultCache().stats()
+        self.statusBar().showMessage('Background %s in %d iterations (fit cache: %d%% hits, %d entries)' % (
+            'from cache' if worker.cached else 'calculated', it, 100 * stats['hit_rate'], stats['entries']),
+            2000)
+        if worker.path == self.current:
+            self.has_background = True
+            self.background = z
+            self.fit_result = (worker.parameters, a, it, info)
+            self.plot_data()
+
+    def fit_finished(self):
+        worker = self.sender()
+        if worker is self.worker:
+            self.worker = None
+        worker.deleteLater()
+
+    def fit_failed(self, message):
+        if self.sender() is self.worker:
+            self.statusBar().showMessage('Background calculation failed: %s' % message, 5000)
     
     def create_main_frame(self):
+        from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
+        from matplotlib.figure import Figure
         self.main_frame = QWidget()
         
         self.dpi = 100
@@ -178,6 +777,7 @@ class AppForm(QMainWindow):
         
         self.axes = self.fig.add_subplot(211)
         self.axes2 = self.fig.add_subplot(212)
+        self.create_plot()
         
         # Create the navigation toolbar, tied to the canvas
         self.mpl_toolbar = NavigationToolbar(self.canvas, self.main_frame)
@@ -185,13 +785,13 @@ class AppForm(QMainWindow):
         # Other GUI controls
 
         # Order of the polynomial
-        order_label = QLabel('Order')
+        self.order_label = QLabel('Order')
         self.order = QLineEdit()
         self.order.setValidator(QIntValidator(0, 101, self))
         self.order.setMinimumWidth(3)
         self.order.setMaxLength(3)
         order = QVBoxLayout()
-        order.addWidget(order_label)
+        order.addWidget(self.order_label)
         order.addWidget(self.order)
 
         # Threshold (peak detection)
@@ -207,24 +807,42 @@ class AppForm(QMainWindow):
         fit_method_label = QLabel('Fit Method')
 
         self.fit_method = QComboBox(self)
-        self.fit_method.addItem("symmetric Huber function")
-        self.fit_method.addItem("asymmetric Huber function")
-        self.fit_method.addItem("symmetric truncated quadratic")
-        self.fit_method.addItem("asymmetric truncated quadratic")
-        index = self.fit_method.findText('asymmetric truncated quadratic')
+        for text, name in fit_methods().items():
+            self.fit_method.addItem(text, name)
+        index = self.fit_method.findData('atq')
         if index >= 0:
             self.fit_method.setCurrentIndex(index)
+        self.baseline_model = QComboBox(self)
+        for text in BASELINE_MODELS:
+            self.baseline_model.addItem(text)
         fit_method = QVBoxLayout()
         fit_method.addWidget(fit_method_label)
         fit_method.addWidget(self.fit_method)
+        fit_method.addWidget(self.baseline_model)
+
+        # Smoothness (P-spline penalty)
+        smoothness_label = QLabel('Smoothness')
+        self.smoothness = QLineEdit('1e-3')
+        self.smoothness.setMinimumWidth(3)
+        self.smoothness.setValidator(QDoubleValidator(bottom=0))
+        self.smoothness.setEnabled(False)
+        smoothness = QVBoxLayout()
+        smoothness.addWidget(smoothness_label)
+        smoothness.addWidget(self.smoothness)
         
         self.draw_button = QPushButton("&Background")
         self.draw_button.setEnabled(False)
         self.connect(self.draw_button, SIGNAL('clicked()'), self.calculate_background)
 
+        self.connect(self.order, SIGNAL('editingFinished()'), self.parameters_changed)
+        self.connect(self.threshold, SIGNAL('editingFinished()'), self.parameters_changed)
+        self.connect(self.fit_method, SIGNAL('currentIndexChanged(int)'), self.parameters_changed)
+        self.connect(self.baseline_model, SIGNAL('currentIndexChanged(int)'), self.baseline_model_changed)
+        self.connect(self.smoothness, SIGNAL('editingFinished()'), self.parameters_changed)
+
         self.grid_cb = QCheckBox("Show &Grid")
         self.grid_cb.setChecked(False)
-        self.connect(self.grid_cb, SIGNAL('stateChanged(int)'), self.plot_data)
+        self.connect(self.grid_cb, SIGNAL('stateChanged(int)'), self.on_grid_changed)
         
         # Layout with box sizers
         hbox = QHBoxLayout()
@@ -235,6 +853,8 @@ class AppForm(QMainWindow):
         hbox.setAlignment(threshold, Qt.AlignVCenter)
         hbox.addLayout(fit_method)
         hbox.setAlignment(fit_method, Qt.AlignVCenter)
+        hbox.addLayout(smoothness)
+        hbox.setAlignment(smoothness, Qt.AlignVCenter)
 #        for w in [  self.order, self.threshold, self.draw_button, self.remove_button, self.grid_cb,
         for w in [ self.draw_button, self.grid_cb,]:
             hbox.addWidget(w)
@@ -248,6 +868,15 @@ class AppForm(QMainWindow):
         
         self.main_frame.setLayout(vbox)
         self.setCentralWidget(self.main_frame)
+
+        # Spectra of the workspace
+        self.spectra = QListWidget()
+        self.spectrum_items = {}  # path: item
+        self.connect(self.spectra, SIGNAL('currentItemChanged(QListWidgetItem*,QListWidgetItem*)'),
+                     self.spectrum_selected)
+        dock = QDockWidget('Spectra', self)
+        dock.setWidget(self.spectra)
+        self.addDockWidget(Qt.LeftDockWidgetArea, dock)
     
     def create_status_bar(self):
         self.status_text = QLabel("")
@@ -259,20 +888,33 @@ class AppForm(QMainWindow):
         load_file_action = self.create_action("&Load file",
             shortcut="Ctrl+O", slot=self.load_csv, 
             tip="Load data")
+        add_files_action = self.create_action("&Add files...",
+            shortcut="Ctrl+Shift+O", slot=self.add_files, 
+            tip="Add files to the spectra, with the parameters of the last loaded file")
         calculate_action = self.create_action("Calculate &Background",
             shortcut="Ctrl+B", slot=self.calculate_background, 
             tip="Calculate Background")
+        fit_all_action = self.create_action("Fit a&ll spectra",
+            shortcut="Ctrl+Shift+B", slot=self.fit_all, 
+            tip="Calculate the background of every spectrum")
+        cancel_action = self.create_action("&Cancel Background",
+            shortcut="Esc", slot=self.cancel_background, 
+            tip="Cancel the background calculation")
+        sweep_action = self.create_action("Parameter s&weep...",
+            shortcut="Ctrl+W", slot=self.parameter_sweep, 
+            tip="Fit a grid of parameters and compare them")
         save_file_action = self.create_action("&Save plot",
             shortcut="Ctrl+S", slot=self.save_plot, 
             tip="Save the plot")
-        export_csv_action = self.create_action("&Export (.csv)",
+        export_csv_action = self.create_action("&Export (.csv, .npz, .npy)",
             shortcut="Ctrl+E", slot=self.export_csv, 
-            tip="Export to csv")
+            tip="Export to csv or numpy binary")
         quit_action = self.create_action("&Quit", slot=self.close, 
             shortcut="Ctrl+Q", tip="Close the application")
         
         self.add_actions(self.file_menu, 
-            (load_file_action, calculate_action, save_file_action, export_csv_action, None, quit_action))
+            (load_file_action, add_files_action, calculate_action, fit_all_action, cancel_action, sweep_action,
+             save_file_action, export_csv_action, None, quit_action))
         
         self.help_menu = self.menuBar().addMenu("&Help")
         about_action = self.create_action("&About", 
@@ -305,10 +947,23 @@ class AppForm(QMainWindow):
             action.setCheckable(True)
         return action
 
+    def closeEvent(self, event):
+        # let every fit stop (replaced and cancelled ones too) before the
+        # threads are destroyed with the window
+        workers = list(self.workers)
+        for worker in workers:
+            worker.cancel()
+        for worker in workers:
+            worker.wait()
+        QMainWindow.closeEvent(self, event)
+
 def main():
     app = QApplication(sys.argv)
     form = AppForm()
     form.show()
+    if '--quit-after-show' in sys.argv:
+        # time to first window (see benchmark.py): quit once the window is drawn
+        QTimer.singleShot(0, app.quit)
     app.exec_()
 
 if __name__ == "__main__":
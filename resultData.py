@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Binary export of background removal results
+
+* saveResult / loadResult: one spectrum (x, y, background, corrected data,
+  coefficients and fit parameters) in a .npy or .npz file
+* createResultStore / openResultStore: many spectra sharing one x-axis,
+  written by chunks in a directory of .npy columns
+
+Everything is written as raw float64, without text formatting. .npy files
+(single spectrum or store columns) are read back memory-mapped, without copy.
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import json
+import os
+
+import numpy as np
+
+# columns of a single spectrum result
+COLUMNS = ('x', 'y', 'background', 'corrected')
+
+
+def saveResult(path, x, y, background, coefficients=None, parameters=None, compressed=False):
+    """ Write one spectrum and its background to a .npy or .npz file
+
+    .npz: one array per column, plus coefficients and parameters (as JSON),
+          zip-compressed if compressed.
+    .npy: a structured array with one field per column; coefficients and
+          parameters go to a <path>.json sidecar file.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    background = np.asarray(background, dtype=float)
+    coefficients = np.zeros(0) if coefficients is None else np.ravel(coefficients)
+    parameters = parameters or {}
+
+    if os.path.splitext(path)[1].lower() == '.npz':
+        save = np.savez_compressed if compressed else np.savez
+        with open(path, 'wb') as f:
+            save(f, x=x, y=y, background=background, corrected=y-background,
+                 coefficients=coefficients, parameters=np.array(json.dumps(parameters)))
+    else:
+        data = np.empty(len(x), dtype=[(c, float) for c in COLUMNS])
+        data['x'] = x
+        data['y'] = y
+        data['background'] = background
+        data['corrected'] = y - background
+        np.save(path, data)
+        with open(path + '.json', 'w') as f:
+            json.dump({'coefficients': coefficients.tolist(), 'parameters': parameters}, f)
+
+
+def loadResult(path, memoryMap=True):
+    """ Read a file written by saveResult as a dict
+
+    Columns of .npy files are memory-mapped views (read-only) if memoryMap.
+    """
+    if os.path.splitext(path)[1].lower() == '.npz':
+        with np.load(path) as data:
+            result = dict((c, data[c]) for c in COLUMNS)
+            result['coefficients'] = data['coefficients']
+            result['parameters'] = json.loads(str(data['parameters']))
+        return result
+
+    data = np.load(path, mmap_mode='r' if memoryMap else None)
+    result = dict((c, data[c]) for c in COLUMNS)
+    result['coefficients'] = np.zeros(0)
+    result['parameters'] = {}
+    if os.path.exists(path + '.json'):
+        with open(path + '.json') as f:
+            sidecar = json.load(f)
+        result['coefficients'] = np.array(sidecar['coefficients'])
+        result['parameters'] = sidecar['parameters']
+    return result
+
+
+class resultStore():
+    """ Columnar container of many spectra sharing one x-axis
+
+    The directory holds x.npy (points), y.npy, background.npy and
+    corrected.npy (spectra x points), coefficients.npy (spectra x
+    coefficients of a fit) and parameters.json. Columns are memory-mapped, so spectra can be written
+    by chunks without holding the whole set in memory.
+    """
+    def __init__(self, directory, mode='r+'):
+        self.directory = directory
+        with open(os.path.join(directory, 'parameters.json')) as f:
+            self.parameters = json.load(f)
+        self.x = np.load(os.path.join(directory, 'x.npy'), mmap_mode='r')
+        for c in COLUMNS[1:] + ('coefficients',):
+            setattr(self, c, np.load(os.path.join(directory, c + '.npy'), mmap_mode=mode))
+
+    def __len__(self):
+        return len(self.y)
+
+    def write(self, start, y, background, coefficients=None):
+        """ Write the spectra start, start+1, ... (one per row of y)
+        """
+        y = np.atleast_2d(y)
+        stop = start + len(y)
+        self.y[start:stop] = y
+        self.background[start:stop] = background
+        self.corrected[start:stop] = y - background
+        if coefficients is not None:
+            self.coefficients[start:stop] = np.reshape(coefficients, (len(y), -1))
+
+    def flush(self):
+        for c in COLUMNS[1:] + ('coefficients',):
+            getattr(self, c).flush()
+
+
+def createResultStore(directory, x, nSpectra, order, parameters=None, model='polynomial'):
+    """ Create an empty resultStore for nSpectra spectra on the x-axis x
+
+    The fits have order+1 coefficients for a polynomial model, order+3
+    (B-spline coefficients of order segments) for 'pspline'.
+    """
+    if model not in ('polynomial', 'pspline'):
+        raise ValueError("Unknown model '%s', expected polynomial or pspline" % model)
+    nCoefficients = order + (3 if model == 'pspline' else 1)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    x = np.asarray(x, dtype=float)
+    np.save(os.path.join(directory, 'x.npy'), x)
+    for c in COLUMNS[1:]:
+        np.lib.format.open_memmap(os.path.join(directory, c + '.npy'), mode='w+',
+                                  dtype=float, shape=(nSpectra, len(x))).flush()
+    np.lib.format.open_memmap(os.path.join(directory, 'coefficients.npy'), mode='w+',
+                              dtype=float, shape=(nSpectra, nCoefficients)).flush()
+    with open(os.path.join(directory, 'parameters.json'), 'w') as f:
+        json.dump(parameters or {}, f)
+    return resultStore(directory)
+
+
+def openResultStore(directory):
+    """ Open a resultStore read-only (memory-mapped)
+    """
+    return resultStore(directory, mode='r')
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Local background removal service with micro-batching
+
+    python service.py --socket /tmp/backcor.sock      (or --port 8765, on localhost)
+    python service.py --demo 16                       (service and 16 clients in one process)
+
+Clients send spectra with the parameters of their fit (order, threshold,
+fct and the backcor options of FIT_OPTIONS). Requests sharing the axis and
+all the parameters but the threshold are grouped and fitted together by
+backcor.backcor_batch on a pool of threads, where they also share the
+projector of their axis (backcor.projector_cache). A batch leaves MAX_DELAY
+seconds after its first spectrum arrived if a thread is free, or as soon as
+it holds MAX_BATCH spectra: while all the threads are busy, batches grow
+with the load. Fits stop after backcor.DEFAULT_MAX_ITER iterations unless
+the request sets max_iter, and the requests of a batch not fitted within
+TIMEOUT seconds fail. Each reply holds the background, the iterations, whether the fit
+converged, the latency of the request in the service, the size of its
+batch and the queue depth (requests received and not answered yet); a
+stats request returns the counters and latency percentiles of the service.
+A message that cannot be read gets an error reply (with a null id) and
+closes the connection.
+
+Messages are a 4-byte big-endian length, a JSON header of that length and
+'bytes' (from the header) bytes of little-endian float64 arrays: x then y
+for a fit, the background for its reply.
+
+    async with BackcorClient(path='/tmp/backcor.sock') as client:
+        z, reply = await client.fit(x, y, order=4, threshold=50)
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import backcor
+
+# backcor options of a request; requests of a batch share them
+FIT_OPTIONS = ('model', 'smoothness', 'solver', 'max_iter', 'tol')
+# seconds to fit a batch before its requests fail
+TIMEOUT = 60.
+
+_LENGTH = struct.Struct('>I')
+
+
+class ServiceError(Exception):
+    '''
+    A request failed in the service (the message is the reason).
+    '''
+
+
+async def read_message(reader):
+    '''
+    (header, payload) of the next message of the stream READER, or None at
+    its end.
+    '''
+    try:
+        prefix = await reader.readexactly(_LENGTH.size)
+    except asyncio.IncompleteReadError:
+        return None
+    header = json.loads((await reader.readexactly(_LENGTH.unpack(prefix)[0])).decode())
+    if not isinstance(header, dict):
+        raise ValueError('the header of a message must be a JSON object')
+    payload = await reader.readexactly(int(header.get('bytes', 0)))
+    return header, payload
+
+
+def write_message(writer, header, *arrays):
+    '''
+    Write HEADER and the float64 ARRAYS to the stream WRITER (to be drained).
+    '''
+    payload = b''.join(np.ascontiguousarray(a, dtype='<f8').tobytes() for a in arrays)
+    data = json.dumps(dict(header, bytes=len(payload))).encode()
+    writer.write(_LENGTH.pack(len(data)) + data + payload)
+
+
+class _Batch(object):
+    '''
+    Spectra waiting to be fitted together on the axis X.
+    '''
+    def __init__(self, x, order, fct, options):
+        self.x = x
+        self.order = order
+        self.fct = fct
+        self.options = options
+        self.y = []
+        self.thresholds = []
+        self.futures = []
+        self.timer = None
+        self.ready = False          # waited MAX_DELAY
+
+    def fit(self):
+        threshold = np.array(self.thresholds)
+        if (threshold == threshold[0]).all():
+            threshold = threshold[0]
+        z, a, it, info = backcor.backcor_batch(self.x, np.array(self.y), self.order, threshold, self.fct,
+                                               full_output=True, **self.options)
+        return z, it, info['converged']
+
+
+class BackcorService(object):
+    '''
+    Micro-batching background removal service.
+
+    Spectra sharing their axis, order, fct and options are fitted together
+    on a pool of JOBS threads (default: one per cpu). A batch is fitted
+    once MAX_DELAY seconds have passed since its first spectrum arrived and
+    a thread is free (oldest batches first), or as soon as it holds
+    MAX_BATCH spectra. Fits stop after MAX_ITER iterations unless their
+    request sets max_iter. The requests of a batch not fitted within
+    TIMEOUT seconds (None: no limit) fail, its thread staying busy until
+    the fit returns. The latency statistics cover the last HISTORY
+    requests.
+    '''
+    def __init__(self, max_batch=64, max_delay=0.001, jobs=None, history=1000,
+                 max_iter=backcor.DEFAULT_MAX_ITER, timeout=TIMEOUT):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_iter = max_iter
+        self.timeout = timeout
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.unconverged = 0        # fits stopped at max_iter
+        self.timeouts = 0           # batches not fitted within TIMEOUT
+        self.depth = 0              # requests received and not answered
+        self._running = 0           # batches being fitted
+        self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+        self._batches = {}          # batches waiting, by key, oldest first
+        self._latencies = collections.deque(maxlen=history)
+        self._sizes = collections.deque(maxlen=history)
+        self._server = None
+
+    async def start(self, path=None, port=0, host='127.0.0.1'):
+        '''
+        Serve on the Unix socket PATH, or on HOST:PORT (PORT 0 picks a free
+        port, see address).
+        '''
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._serve, path)
+        else:
+            self._server = await asyncio.start_server(self._serve, host, port)
+        return self
+
+    def address(self):
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._pool.shutdown()
+
+    async def fit(self, x, y, order, threshold, fct='atq', **options):
+        '''
+        (background, iterations, converged, batch size) of the spectrum
+        (X, Y), fitted in a batch with the other requests on the same axis
+        and parameters.
+        '''
+        backcor.get_cost(fct)  # unknown cost functions raise ValueError
+        unknown = set(options) - set(FIT_OPTIONS)
+        if unknown:
+            raise ValueError('Unknown options %s' % ', '.join(sorted(unknown)))
+        if len(x) != len(y):
+            raise ValueError('x and y must have the same length')
+        options.setdefault('max_iter', self.max_iter)
+        key = (hashlib.sha1(np.ascontiguousarray(x)).hexdigest(), len(x), order, fct, tuple(sorted(options.items())))
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch(x, order, fct, options)
+            batch.timer = loop.call_later(self.max_delay, self._expired, key)
+        future = loop.create_future()
+        batch.y.append(y)
+        batch.thresholds.append(threshold)
+        batch.futures.append(future)
+        if len(batch.futures) >= self.max_batch:
+            self._dispatch(key)
+        return await future
+
+    def stats(self):
+        '''
+        Counters of the service, and the batch sizes and latencies (s) of
+        the last requests.
+        '''
+        latencies = np.array(self._latencies)
+        stats = {'requests': self.requests,
+                 'batches': self.batches,
+                 'errors': self.errors,
+                 'unconverged': self.unconverged,
+                 'timeouts': self.timeouts,
+                 'queue_depth': self.depth,
+                 'running_batches': self._running,
+                 'waiting_batches': len(self._batches),
+                 'mean_batch_size': float(np.mean(self._sizes)) if self._sizes else 0.}
+        for name, q in (('p50', 50), ('p95', 95), ('max', 100)):
+            stats['latency_' + name] = float(np.percentile(latencies, q)) if len(latencies) else 0.
+        return stats
+
+    def _expired(self, key):
+        batch = self._batches.get(key)
+        if batch is not None:
+            batch.ready = True
+            self._dispatch_ready()
+
+    def _dispatch_ready(self):
+        for key in [key for key, batch in self._batches.items() if batch.ready]:
+            if self._running >= self.jobs:
+                break
+            self._dispatch(key)
+
+    def _dispatch(self, key):
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        self.batches += 1
+        self._running += 1
+        self._sizes.append(len(batch.futures))
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        fitting = asyncio.get_running_loop().run_in_executor(self._pool, batch.fit)
+        # the thread is busy until the fit returns, even after a timeout
+        fitting.add_done_callback(self._fitted)
+        try:
+            z, it, converged = await asyncio.wait_for(asyncio.shield(fitting), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            error = TimeoutError('batch of %d spectra not fitted within %g s' % (len(batch.futures), self.timeout))
+        except Exception as e:
+            error = e
+        else:
+            self.unconverged += int(np.count_nonzero(~converged))
+            for k, future in enumerate(batch.futures):
+                if not future.done():
+                    future.set_result((z[k], int(it[k]), bool(converged[k]), len(batch.futures)))
+            return
+        for future in batch.futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def _fitted(self, fitting):
+        if not fitting.cancelled():
+            fitting.exception()     # reported to the requests by _run
+        self._running -= 1
+        self._dispatch_ready()
+
+    async def _serve(self, reader, writer):
+        replies = set()
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                except (ValueError, TypeError) as e:
+                    # the rest of the stream cannot be framed: answer and close
+                    self.errors += 1
+                    write_message(writer, {'id': None, 'error': 'invalid message: %s: %s' % (type(e).__name__, e)})
+                    await writer.drain()
+                    break
+                if message is None:
+                    break
+                header, payload = message
+                if header.get('type') == 'stats':
+                    write_message(writer, dict(self.stats(), id=header.get('id')))
+                    await writer.drain()
+                else:
+                    # replies are written as their batch completes, in any order
+                    reply = asyncio.ensure_future(self._reply(writer, header, payload))
+                    replies.add(reply)
+                    reply.add_done_callback(replies.discard)
+            if replies:
+                await asyncio.wait(replies)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _reply(self, writer, header, payload):
+        received = time.perf_counter()
+        self.requests += 1
+        self.depth += 1
+        reply = {'id': header.get('id'), 'queue_depth': self.depth}
+        try:
+            points = int(header['points'])
+            if len(payload) != 16 * points:
+                raise ValueError('expected %d bytes of data, got %d' % (16 * points, len(payload)))
+            data = np.frombuffer(payload, dtype='<f8')
+            z, it, converged, size = await self.fit(data[:points], data[points:], int(header['order']),
+                                                    float(header['threshold']), header.get('fct', 'atq'),
+                                                    **header.get('options', {}))
+            reply.update(iterations=it, converged=converged, batch_size=size)
+            arrays = (z,)
+        except Exception as e:
+            self.errors += 1
+            reply['error'] = '%s: %s' % (type(e).__name__, e)
+            arrays = ()
+        finally:
+            self.depth -= 1
+        reply['latency'] = time.perf_counter() - received
+        self._latencies.append(reply['latency'])
+        try:
+            write_message(writer, reply, *arrays)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class BackcorClient(object):
+    '''
+    Connection to a BackcorService on the Unix socket PATH or on HOST:PORT.
+    Several requests can be awaited at once on a connection.
+    '''
+    def __init__(self, path=None, port=None, host='127.0.0.1'):
+        self.path = path
+        self.port = port
+        self.host = host
+        self._pending = {}
+        self._next_id = 0
+        self._writer = None
+        self._reading = None
+
+    async def connect(self):
+        if self.path is not None:
+            reader, self._writer = await asyncio.open_unix_connection(self.path)
+        else:
+            reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._reading = asyncio.ensure_future(self._read(reader))
+        return self
+
+    async def close(self):
+        self._writer.close()
+        await self._reading
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def fit(self, x, y, order, threshold, fct='atq', **options):
+        '''
+        (background, reply) of the spectrum (X, Y), REPLY holding the
+        iterations, converged, latency (s), batch_size and queue_depth of
+        the request.
+        OPTIONS are backcor options of FIT_OPTIONS. Raises ServiceError if
+        the fit failed.
+        '''
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float)
+        if y.size != x.size:
+            raise ValueError('x and y must have the same length')
+        header, payload = await self._request({'type': 'fit', 'points': len(x), 'order': order,
+                                               'threshold': threshold, 'fct': fct, 'options': options}, x, y)
+        if 'error' in header:
+            raise ServiceError(header['error'])
+        return np.frombuffer(payload, dtype='<f8').reshape(np.shape(y)), header
+
+    async def stats(self):
+        header, payload = await self._request({'type': 'stats'})
+        return header
+
+    async def _request(self, header, *arrays):
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_id] = future
+        write_message(self._writer, dict(header, id=self._next_id), *arrays)
+        await self._writer.drain()
+        return await future
+
+    async def _read(self, reader):
+        error = ConnectionError('connection to the service closed')
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                if message[0].get('id') is None and 'error' in message[0]:
+                    # the service could not read a request and closes the connection
+                    error = ServiceError(message[0]['error'])
+                    break
+                future = self._pending.pop(message[0].get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except ConnectionError:
+            pass
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+
+async def demo(clients=16, spectra=32, points=2000, path=None, **service_options):
+    '''
+    Run a service and CLIENTS clients each fitting SPECTRA synthetic spectra
+    of POINTS points (on a common axis) one after the other, and return the
+    stats of the service and the elapsed time.
+    '''
+    directory = None
+    if path is None:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'backcor.sock')
+    service = await BackcorService(**service_options).start(path)
+    x = np.linspace(100., 1000., points)
+
+    async def client(seed):
+        rng = np.random.RandomState(seed)
+        async with BackcorClient(path) as connection:
+            for k in range(spectra):
+                center = rng.uniform(200., 900.)
+                y = 1e-3 * x + 2. / (1. + ((x - center) / 10.) ** 2) + 0.01 * rng.randn(points)
+                await connection.fit(x, y, 4, 0.05)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[client(seed) for seed in range(clients)])
+        elapsed = time.perf_counter() - start
+        stats = service.stats()
+    finally:
+        await service.close()
+        if directory is not None:
+            os.remove(path)
+            os.rmdir(directory)
+    return stats, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local background removal service with micro-batching")
+    parser.add_argument("--socket", default=None, help="Unix socket to serve on")
+    parser.add_argument("--port", default=None, type=int, help="port to serve on, on localhost")
+    parser.add_argument("--max-batch", default=64, type=int, help="maximum number of spectra per batch")
+    parser.add_argument("--max-delay", default=0.001, type=float,
+                        help="minimum wait for a batch to fill, when a thread is free (s)")
+    parser.add_argument("--max-iter", default=backcor.DEFAULT_MAX_ITER, type=int,
+                        help="maximum number of iterations of a fit whose request does not set it")
+    parser.add_argument("--timeout", default=TIMEOUT, type=float, help="maximum time to fit a batch (s)")
+    parser.add_argument("-j", "--jobs", default=None, type=int, help="number of fitting threads")
+    parser.add_argument("--demo", default=None, type=int, metavar="CLIENTS",
+                        help="run the service with CLIENTS synthetic clients and print its stats")
+    args = parser.parse_args(argv)
+    options = {'max_batch': args.max_batch, 'max_delay': args.max_delay, 'jobs': args.jobs,
+               'max_iter': args.max_iter, 'timeout': args.timeout}
+
+    if args.demo is not None:
+        stats, elapsed = asyncio.run(demo(args.demo, path=args.socket, **options))
+        sys.stdout.write('%d spectra in %.3f s (%.0f spectra/s), %d batches (%.1f spectra on average), '
+                         'latency p50 %.1f ms, p95 %.1f ms, %d unconverged, %d errors\n' % (
+                             stats['requests'], elapsed, stats['requests'] / elapsed, stats['batches'],
+                             stats['mean_batch_size'], 1e3 * stats['latency_p50'], 1e3 * stats['latency_p95'],
+                             stats['unconverged'], stats['errors']))
+        return
+    if (args.socket is None) == (args.port is None):
+        parser.error('give either --socket or --port')
+
+    async def serve():
+        service = await BackcorService(**options).start(args.socket, args.port)
+        sys.stdout.write('serving on %s\n' % (service.address(),))
+        sys.stdout.flush()
+        await service.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
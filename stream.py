@@ -0,0 +1,234 @@
+"""
+Background removal of data that arrive while they are acquired
+
+    estimator = SlidingBackcor(window=4096, order=4, threshold=50)
+    for x, y in acquisition:                    # chunks of samples
+        x, corrected, background = estimator.push(x, y)
+        ...
+    x, corrected, background = estimator.flush()
+
+fits the background of the last WINDOW samples of a stream with the cost
+functions of backcor, and emits each sample, corrected, once DELAY newer
+samples have arrived. The normal equations (T'T and T'y of the Chebyshev
+basis T) are updated with the new samples and downdated with the samples
+leaving the window, and each fit starts from the previous coefficients
+(unless least squares has a lower cost), so a chunk costs a few passes over
+the window whatever the length of the stream. Memory is fixed by WINDOW.
+
+stream() and astream() run an estimator over an iterable or an async
+iterable of (x, y) chunks. stream_spectra() removes the background of
+complete spectra as they arrive.
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import numpy as np
+
+import backcor
+
+
+class SlidingBackcor(object):
+    '''
+    Sliding-window background estimation of a stream of samples.
+
+    The background of the last WINDOW samples is a polynomial of order ORDER
+    minimizing the cost function FCT with parameter THRESHOLD (in the units
+    of y, as in backcor). A sample is emitted once DELAY newer samples have
+    been pushed (default WINDOW // 2, which centres it in the window), so
+    the latency is at most DELAY samples after the chunk that completes it.
+    The iterations of each fit stop at the relative change TOL or after
+    MAX_ITER iterations (see iterations).
+    '''
+    def __init__(self, window, order, threshold, fct='atq', delay=None, tol=1e-9, max_iter=100):
+        if delay is None:
+            delay = window // 2
+        if not 0 <= delay < window:
+            raise ValueError('delay must be in [0, window)')
+        backcor.get_cost(fct)  # unknown cost functions raise ValueError
+        self.window = window
+        self.order = order
+        self.threshold = threshold
+        self.fct = fct
+        self.delay = delay
+        self.tol = tol
+        self.max_iter = max_iter
+        self.iterations = 0         # iterations of the last fit
+
+        self._alpha = 0.99 * 1/2
+        self._x = np.empty(window)
+        self._y = np.empty(window)
+        self._T = np.empty((window, order+1))
+        self._count = 0             # samples in the window
+        self._pending = 0           # newest samples not emitted yet
+        self._G = np.zeros((order+1, order+1))
+        self._Ty = np.zeros(order+1)
+        self._origin = None         # x = origin + scale * u, with u the axis of T
+        self._scale = None
+        self._coefs = None
+
+    def push(self, x, y):
+        '''
+        Add the samples (X, Y) to the stream and return (x, corrected,
+        background) of the samples that can be emitted (possibly empty).
+        '''
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        if x.shape != y.shape or x.ndim != 1:
+            raise ValueError('x and y must be 1-D arrays of the same length')
+        out = []
+        step = self.window - self.delay
+        for start in range(0, len(x), step):
+            self._append(x[start:start+step], y[start:start+step])
+            self._fit()
+            out.append(self._emit(self._pending - self.delay))
+        return _concatenate(out)
+
+    def flush(self):
+        '''
+        Emit the samples still waiting for newer ones, with the current fit.
+        '''
+        return self._emit(self._pending)
+
+    def background(self, x):
+        '''
+        Current background estimation at X.
+        '''
+        if self._coefs is None:
+            raise ValueError('no samples pushed yet')
+        u = (np.asarray(x, dtype=float) - self._origin) / self._scale
+        return np.polynomial.chebyshev.chebval(u, self._coefs)
+
+    def _append(self, x, y):
+        count, c = self._count, len(x)
+        overflow = count + c - self.window
+        if overflow > 0:
+            # downdate with the oldest samples, which have all been emitted
+            T = self._T[:overflow]
+            self._G -= np.dot(T.T, T)
+            self._Ty -= np.dot(T.T, self._y[:overflow])
+            count -= overflow
+            self._x[:count] = self._x[overflow:overflow+count]
+            self._y[:count] = self._y[overflow:overflow+count]
+            self._T[:count] = self._T[overflow:overflow+count]
+        self._x[count:count+c] = x
+        self._y[count:count+c] = y
+        self._count = count + c
+        self._pending += c
+
+        lo = self._x[:self._count].min()
+        hi = self._x[:self._count].max()
+        if self._origin is None or lo < self._origin - 1.5*self._scale or hi > self._origin + 1.5*self._scale:
+            # the window moved away from the axis of T: rescale and rebuild
+            origin, scale = self._origin, self._scale
+            self._origin = (lo + hi) / 2
+            self._scale = (hi - lo) / 2 or 1.
+            self._T[:self._count] = self._basis(self._x[:self._count])
+            T = self._T[:self._count]
+            self._G = np.dot(T.T, T)
+            self._Ty = np.dot(T.T, self._y[:self._count])
+            if self._coefs is not None and count == self.window - c:
+                # same polynomial on the new axis (exact at order+1 Chebyshev points),
+                # once the fits are made on full windows
+                u = np.polynomial.chebyshev.chebpts1(self.order+1)
+                z = np.polynomial.chebyshev.chebval((self._origin + self._scale*u - origin) / scale, self._coefs)
+                self._coefs = np.polynomial.chebyshev.chebfit(u, z, self.order)
+            else:
+                self._coefs = None
+        else:
+            T = self._T[count:count+c] = self._basis(x)
+            self._G += np.dot(T.T, T)
+            self._Ty += np.dot(T.T, y)
+
+    def _basis(self, x):
+        return np.polynomial.chebyshev.chebvander((x - self._origin) / self._scale, self.order)
+
+    def _fit(self):
+        T = self._T[:self._count]
+        y = self._y[:self._count]
+        Ginv = np.linalg.pinv(self._G)
+        # start from the previous fit, unless least squares does better on
+        # this window (e.g. after a fit on the first few samples)
+        c = np.dot(Ginv, self._Ty)
+        z = np.dot(T, c)
+        if self._coefs is not None:
+            zp = np.dot(T, self._coefs)
+            if backcor.cost(y - zp, self.threshold, self.fct) < backcor.cost(y - z, self.threshold, self.fct):
+                c, z = self._coefs, zp
+        it = 0
+        while it < self.max_iter:
+            it += 1
+            d = backcor._estimate_d(y - z, self.threshold, self.fct, self._alpha)
+            c = np.dot(Ginv, self._Ty + np.dot(T.T, d))
+            zp, z = z, np.dot(T, c)
+            change = np.dot(z-zp, z-zp) / (np.dot(zp, zp) or 1.)
+            if change <= self.tol:
+                break
+        self._coefs = c
+        self.iterations = it
+
+    def _emit(self, k):
+        if k <= 0:
+            return _concatenate([])
+        start = self._count - self._pending
+        x = self._x[start:start+k].copy()
+        y = self._y[start:start+k]
+        z = np.dot(self._T[start:start+k], self._coefs)
+        self._pending -= k
+        return x, y - z, z
+
+
+def _concatenate(chunks):
+    chunks = [c for c in chunks if len(c[0])]
+    if not chunks:
+        return np.empty(0), np.empty(0), np.empty(0)
+    return tuple(np.concatenate(a) for a in zip(*chunks))
+
+
+def stream(chunks, window, order, threshold, fct='atq', **kwargs):
+    '''
+    Generator of the (x, corrected, background) chunks of a SlidingBackcor
+    fed with the (x, y) CHUNKS of an iterable. Other keywords are passed to
+    SlidingBackcor.
+    '''
+    estimator = SlidingBackcor(window, order, threshold, fct, **kwargs)
+    for x, y in chunks:
+        out = estimator.push(x, y)
+        if len(out[0]):
+            yield out
+    out = estimator.flush()
+    if len(out[0]):
+        yield out
+
+
+async def astream(chunks, window, order, threshold, fct='atq', **kwargs):
+    '''
+    Asynchronous counterpart of stream for an async iterable of (x, y)
+    CHUNKS (e.g. reading from an instrument).
+    '''
+    estimator = SlidingBackcor(window, order, threshold, fct, **kwargs)
+    async for x, y in chunks:
+        out = estimator.push(x, y)
+        if len(out[0]):
+            yield out
+    out = estimator.flush()
+    if len(out[0]):
+        yield out
+
+
+def stream_spectra(spectra, order, threshold, fct='atq', warm_start=False, **kwargs):
+    '''
+    Generator of (x, corrected, background) for an iterable of complete
+    (x, y) SPECTRA. Spectra sharing an axis reuse its projector (see
+    backcor.projector_cache). With WARM_START, each fit starts from the
+    background of the previous spectrum of the same length, which saves
+    iterations on slowly changing spectra (with the asymmetric functions,
+    the baseline should not rise by more than THRESHOLD from one spectrum
+    to the next). Other keywords are passed to backcor.backcor.
+    '''
+    z = None
+    for x, y in spectra:
+        y = np.asarray(y, dtype=float)
+        z0 = z if warm_start and z is not None and np.shape(z) == y.shape else None
+        z, a, it = backcor.backcor(np.asarray(x), y, order, threshold, fct, z0=z0, **kwargs)
+        yield x, y - z, z
@@ -0,0 +1,82 @@
+"""
+Parameter sweep of backcor over order, threshold and cost function
+
+    table = sweep(x, y, orders=[2, 4, 6], thresholds=[10, 50, 100], fcts=['atq', 'stq'])
+
+evaluates every combination on a pool of threads and returns one row per
+fit. The projector of each order is built once (by the first fit of that
+order) and shared through backcor.projector_cache by every other
+threshold and cost function.
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import backcor
+
+# one row of the result table; fct is the name of a registered cost
+# function, of any length
+RESULT_DTYPE = [('order', int),
+                ('threshold', float),
+                ('fct', object),
+                ('iterations', int),
+                ('cost', float),
+                ('time', float)]
+
+
+def sweep(n, y, orders, thresholds, fcts=('atq',), mask=True, solver='pinv', jobs=None,
+          return_backgrounds=False, callback=None):
+    '''
+    Fit Y (on the axis N) with backcor for every combination of ORDERS,
+    THRESHOLDS and FCTS, in parallel on JOBS threads.
+
+    Returns a structured array (see RESULT_DTYPE) with, for each fit, the
+    number of iterations, the value of the cost function on the valid points
+    of MASK and the fit time in seconds. Rows are ordered by order, then
+    threshold, then cost function. If RETURN_BACKGROUNDS, a list of the
+    backgrounds (same order) is also returned. CALLBACK is passed to every
+    backcor fit (from the threads of the pool): raising
+    backcor.FitCancelled from it stops the sweep.
+    '''
+    y = np.asarray(y)
+    valid = np.ones(len(n), dtype=bool) if mask is True else np.ravel(mask).astype(bool)
+    combinations = [(order, threshold, fct) for order in orders for threshold in thresholds for fct in fcts]
+
+    def fit(parameters):
+        order, threshold, fct = parameters
+        start = time.perf_counter()
+        z, a, it = backcor.backcor(n, y, order, threshold, fct, mask=mask, solver=solver, callback=callback)
+        elapsed = time.perf_counter() - start
+        z = np.reshape(z, y.shape)
+        return z, it, backcor.cost((y-z)[valid], threshold, fct), elapsed
+
+    # first fit of each order builds its projector, the others reuse it
+    first = {}
+    for k, (order, threshold, fct) in enumerate(combinations):
+        first.setdefault(order, k)
+    first = sorted(first.values())
+    rest = [k for k in range(len(combinations)) if k not in set(first)]
+
+    results = [None] * len(combinations)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for indexes in (first, rest):
+            for k, result in zip(indexes, pool.map(fit, [combinations[k] for k in indexes])):
+                results[k] = result
+
+    table = np.zeros(len(combinations), dtype=RESULT_DTYPE)
+    for row, (order, threshold, fct), (z, it, value, elapsed) in zip(table, combinations, results):
+        row['order'] = order
+        row['threshold'] = threshold
+        row['fct'] = fct
+        row['iterations'] = it
+        row['cost'] = value
+        row['time'] = elapsed
+
+    if return_backgrounds:
+        return table, [result[0] for result in results]
+    return table
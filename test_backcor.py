@@ -0,0 +1,206 @@
+"""
+Regression tests of backcor
+
+    python -m pytest -q
+"""
+
+import warnings
+
+import numpy as np
+import pytest
+
+import backcor
+
+
+def test_batch_flat_spectrum_stops():
+    # a flat spectrum (no range to rescale) must not keep the batch iterating
+    x = np.linspace(0., 1., 200)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        z, a, it, info = backcor.backcor_batch(x, np.vstack([x**2, np.zeros(200)]), 3, 0.1, full_output=True)
+    assert it[1] == 0
+    assert list(info['converged']) == [True, False]
+    single = backcor.backcor(x, x**2, 3, 0.1)[0]
+    assert np.allclose(z[0], single.ravel())
+
+
+def test_spline_projection_matches_dense_solve():
+    # the banded Cholesky solve, over several blocks and a merged last one
+    n = np.linspace(-1., 1., 2000).reshape((-1, 1))
+    v = np.random.RandomState(0).randn(2000, 2)
+    for segments in (1, 62, 200):
+        P = backcor._SplineProjector(n, segments, 1e-3)
+        K = P.size
+        B = np.zeros((2000, K))
+        for k in range(4):
+            B[np.arange(2000), P.index+k] = P.weights[:, k]
+        D = np.diff(np.eye(K), 2, axis=0)
+        M = np.dot(B.T, B) + 1e-3 * 2000 / K * np.dot(D.T, D)
+        assert np.allclose(P.project(v), np.linalg.solve(M, np.dot(B.T, v)))
+        assert np.isclose(P.cond(), np.linalg.cond(M))
+
+
+def test_coarse_matches_full_fit():
+    # the coarse warm start only runs for the convex costs, where it ends
+    # near the same minimum; the other costs fit from scratch
+    rng = np.random.RandomState(3)
+    x = np.linspace(0., 1000., 20000)
+    y = 1e-5 * (x - 300)**2 + 0.02 * rng.randn(len(x))
+    for c, w in zip(rng.uniform(0, 1000, 20), rng.uniform(1, 5, 20)):
+        y += rng.uniform(.5, 3) / (1 + ((x - c) / w)**2)
+    for fct, cost in backcor.COST_FUNCTIONS.items():
+        z, a, it, info = backcor.backcor(x, y, 6, 0.1, fct, full_output=True, tol=1e-12)
+        zc, ac, itc, infoc = backcor.backcor(x, y, 6, 0.1, fct, full_output=True, tol=1e-12, coarse=1000)
+        if cost.convex:
+            assert infoc['coarse_iterations'] > 0
+            assert np.abs(zc - z).max() < 1e-4 * np.ptp(y)
+            assert backcor.cost(y - zc, 0.1, fct) <= backcor.cost(y - z, 0.1, fct) * (1 + 1e-9)
+        else:
+            assert infoc['coarse_iterations'] == 0
+            assert np.array_equal(zc, z)
+
+
+def test_projector_cond_computed_once(monkeypatch):
+    x = np.linspace(0., 1., 1000)
+    backcor.backcor(x, x**2, 4, 0.1, full_output=True)
+    calls = []
+    monkeypatch.setattr(np.linalg, 'cond', lambda *args: calls.append(args) or 1.)
+    info = backcor.backcor(x, x**2, 4, 0.1, full_output=True)[3]
+    assert calls == []
+    assert info['cond'] > 1.
+
+
+def test_sweep_with_registered_cost():
+    import sweep
+    sh = backcor.get_cost('sh')
+    backcor.register_cost(backcor.CostFunction('my_long_huber', 'test Huber', sh.value, sh.d, sh.branches))
+    try:
+        x = np.linspace(0., 1., 500)
+        y = x**2 + 0.1 * np.exp(-((x - .5) / .01)**2)
+        table = sweep.sweep(x, y, [2, 3], [0.01], ['my_long_huber', 'sh'])
+    finally:
+        del backcor.COST_FUNCTIONS['my_long_huber']
+    assert list(table['fct']) == ['my_long_huber', 'sh'] * 2
+    # same cost function under another name, same fits
+    assert np.array_equal(table['iterations'][::2], table['iterations'][1::2])
+    assert np.allclose(table['cost'][::2], table['cost'][1::2])
+
+
+def test_batch_reuses_cache_instance(tmp_path, monkeypatch):
+    import fitCache
+    import removeBackgroundBatch
+    from csvData import importCsvParameters
+    x = np.linspace(0., 1., 300)
+    for k in range(3):
+        np.savetxt(str(tmp_path / ('s%d.csv' % k)), np.column_stack([x, x**2 + k]), delimiter=',')
+    listings = []
+    entries = fitCache.fitCache.entries
+    monkeypatch.setattr(fitCache.fitCache, 'entries', lambda self: listings.append(1) or entries(self))
+    cache = str(tmp_path / 'cache')
+    for k in range(3):
+        path, n, error, converged, stats, hit = removeBackgroundBatch.process_file(
+            str(tmp_path / ('s%d.csv' % k)), 2, 0.1, 'atq', importCsvParameters(), cache=cache)
+        assert error is None
+    # the directory is listed once, by the first write
+    assert len(listings) == 1
+    assert fitCache.openCache(cache).stats()['entries'] == 3
+
+
+def test_projector_cache_keys_and_eviction():
+    cache = backcor.ProjectorCache()
+    n = np.linspace(-1., 1., 500).reshape((-1, 1))
+    P = cache.get(n, 3, 'pinv')
+    assert cache.get(n, 3, 'pinv') is P
+    assert cache.stats()['hits'] == 1
+    # every part of the key gives another projector
+    others = [cache.get(n[::2], 3, 'pinv'), cache.get(n, 4, 'pinv'), cache.get(n, 3, 'chebyshev'),
+              cache.get(n, 3, 'pinv', 'pspline', 1e-3), cache.get(n, 3, 'pinv', dtype=np.float32)]
+    assert all(Q is not P for Q in others)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 6, 6)
+    # room for two projectors: the least recently used one is evicted
+    axes = [n, n[::-1], -n**3]
+    small = backcor.ProjectorCache(max_bytes=2 * P.nbytes)
+    a, b = small.get(axes[0], 3, 'pinv'), small.get(axes[1], 3, 'pinv')
+    small.get(axes[0], 3, 'pinv')
+    small.get(axes[2], 3, 'pinv')
+    assert small.get(axes[0], 3, 'pinv') is a
+    assert small.get(axes[1], 3, 'pinv') is not b
+    assert small.stats()['entries'] == 2
+
+
+def test_cube_resumes_interrupted_run(tmp_path):
+    import cube
+    x = np.linspace(0., 1., 200)
+    rng = np.random.RandomState(0)
+    data = np.array([x**2 + a * np.exp(-((x - c) / .01)**2) for a, c in rng.uniform(0, 1, (12, 2))])
+    path = str(tmp_path / 'cube.npy')
+    np.save(path, data.reshape((3, 4, 200)))
+    output = str(tmp_path / 'out')
+    summary = cube.process_cube(path, output, 3, 0.01, chunk=5, jobs=1)
+    assert (summary['chunks'], summary['skipped']) == (3, 0)
+    background = np.load(str(tmp_path / 'out' / 'background.npy'))
+
+    # interrupted after the first chunk: the others are fitted on the next run
+    done = np.load(str(tmp_path / 'out' / 'done.npy'), mmap_mode='r+')
+    done[1:] = False
+    done.flush()
+    out = np.load(str(tmp_path / 'out' / 'background.npy'), mmap_mode='r+')
+    out.reshape((12, 200))[5:] = 0.
+    out.flush()
+    del done, out
+    summary = cube.process_cube(path, output, 3, 0.01, chunk=5, jobs=1)
+    assert summary['skipped'] == 1
+    assert np.array_equal(np.load(str(tmp_path / 'out' / 'background.npy')), background)
+    assert np.load(str(tmp_path / 'out' / 'done.npy')).all()
+
+    # other parameters do not resume the run
+    with pytest.raises(ValueError):
+        cube.process_cube(path, output, 4, 0.01, chunk=5, jobs=1)
+
+
+def test_fit_key_and_warm_starts(tmp_path):
+    import fitCache
+    x = np.linspace(0., 1., 300)
+    y = x**2 + np.exp(-((x - .5) / .01)**2)
+    key = fitCache.fitKey(x, y, 3, 0.1, 'atq')
+    # same data and parameters, whatever their types or the ignored options
+    assert fitCache.fitKey(list(x), list(y), 3, np.float64(0.1), 'atq', callback=print, z0=x, jit=True) == key
+    assert fitCache.fitKey(x, y, 3, 0.1, 'atq', dtype=np.float32) == fitCache.fitKey(x, y, 3, 0.1, 'atq',
+                                                                                    dtype='float32')
+    for other in (fitCache.fitKey(x, y + 1e-9, 3, 0.1, 'atq'), fitCache.fitKey(x, y, 4, 0.1, 'atq'),
+                  fitCache.fitKey(x, y, 3, 0.2, 'atq'), fitCache.fitKey(x, y, 3, 0.1, 'stq'),
+                  fitCache.fitKey(x, y, 3, 0.1, 'atq', mask=x < .9), fitCache.fitKey(x, y, 3, 0.1, 'atq', max_iter=5)):
+        assert other != key
+
+    cache = fitCache.fitCache(str(tmp_path))
+    z0 = backcor.backcor(x, y, 3, 0.1, max_iter=2)[0]
+    fitCache.cachedBackcor(x, y, 3, 0.1, cache=cache, z0=z0)
+    assert cache.stats()['entries'] == 0
+    z = fitCache.cachedBackcor(x, y, 3, 0.1, cache=cache)[0]
+    assert cache.stats()['entries'] == 1
+    # a warm start is served the stored fit from scratch
+    assert np.array_equal(fitCache.cachedBackcor(x, y, 3, 0.1, cache=cache, z0=z0)[0], z)
+
+
+def test_result_store_holds_pspline_coefficients(tmp_path):
+    from resultData import createResultStore, openResultStore
+    x = np.linspace(0., 1., 300)
+    y = np.vstack([x**2, x**3])
+    z, a, it = backcor.backcor_batch(x, y, 8, 0.1, model='pspline')
+    store = createResultStore(str(tmp_path), x, 2, 8, model='pspline')
+    store.write(0, y, z, a)
+    store.flush()
+    assert np.array_equal(openResultStore(str(tmp_path)).coefficients, a)
+
+
+def test_evaluate_batch_of_one_coefficient():
+    x = np.linspace(0., 1., 200)
+    y = np.vstack([np.full(200, 1.) + 0.1 * x, np.full(200, 3.) - 0.1 * x, np.full(200, 2.) + x**2])
+    for order, model in ((0, 'polynomial'), (2, 'polynomial'), (4, 'pspline')):
+        z, a, it, info = backcor.backcor_batch(x, y, order, 0.1, model=model, full_output=True)
+        assert np.allclose(backcor.evaluate(x, a, info['xlim'], info['ylim'], model=model, batch=True), z)
+        ylim = [v[0] for v in info['ylim']]
+        assert np.allclose(backcor.evaluate(x, a[0], info['xlim'], ylim, model=model), z[0])
+    with pytest.raises(ValueError):
+        backcor.evaluate(x, a, info['xlim'], info['ylim'], model=model)
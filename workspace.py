@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Spectra of a multi-spectrum session, without any GUI dependency
+
+* workspace: spectra read from their .csv file on first use and kept in
+  memory up to maxBytes, the least recently used ones being released first
+* spectrumEntry: a spectrum of a workspace and its last fit
+
+A released spectrum keeps its fit (parameters, coefficients, iterations,
+info): its background is evaluated again from the coefficients
+(backcor.evaluate) when its data are read back.
+
+Colin Brosseau (colin@erzatz.info)
+License: MIT
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import backcor
+from csvData import importCsvParameters, loadCsv
+
+DEFAULT_MAX_BYTES = 256 * 2**20
+
+
+class spectrumEntry():
+    """ A spectrum of a workspace
+
+    x, y, index (the order of x, for plotting) and background are None while
+    the data are not in memory. fit is (fit parameters, coefficients,
+    iterations, info) of the last fit, or None.
+    """
+    def __init__(self, path, parameters=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.parameters = parameters if parameters else importCsvParameters()
+        self.x = None
+        self.y = None
+        self.index = None
+        self.background = None
+        self.fit = None
+
+    def loaded(self):
+        return self.x is not None
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.x, self.y, self.index, self.background) if a is not None)
+
+    def release(self):
+        """ Drop the data arrays, keeping the fit
+        """
+        self.x = self.y = self.index = self.background = None
+
+
+class workspace():
+    """ Spectra by path, in the order they were added
+
+    Data are read by data() and the least recently used spectra are
+    released while the loaded ones exceed maxBytes; pinned (a path or None)
+    is never released. Safe to use from several threads.
+    """
+    def __init__(self, maxBytes=DEFAULT_MAX_BYTES):
+        self.maxBytes = maxBytes
+        self.pinned = None
+        self.loads = 0  # files read
+        self._spectra = OrderedDict()
+        self._used = OrderedDict()  # paths of the loaded spectra, least recently used first
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._spectra)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._spectra.values()))
+
+    def __contains__(self, path):
+        return path in self._spectra
+
+    def __getitem__(self, path):
+        return self._spectra[path]
+
+    def add(self, path, parameters=None, x=None, y=None):
+        """ Add (or replace) the spectrum of the file at path and return its entry
+
+        x and y, when the file has already been read, are kept in memory;
+        otherwise the file is read on first use.
+        """
+        entry = spectrumEntry(path, parameters)
+        with self._lock:
+            self.remove(path)
+            self._spectra[path] = entry
+            if x is not None:
+                self._store(entry, x, y)
+        return entry
+
+    def remove(self, path):
+        with self._lock:
+            self._spectra.pop(path, None)
+            self._used.pop(path, None)
+
+    def data(self, path):
+        """ (x, y) of a spectrum, read from its file when not in memory
+        """
+        with self._lock:
+            entry = self._spectra[path]
+            if entry.loaded():
+                self._used[path] = self._used.pop(path)
+                return entry.x, entry.y
+        # read without holding the lock, so that the other spectra stay available
+        x, y = loadCsv(entry.path, entry.parameters)
+        with self._lock:
+            self.loads += 1
+            if self._spectra.get(path) is not entry:
+                return x, y
+            if entry.loaded():
+                self._used[path] = self._used.pop(path)
+                return entry.x, entry.y
+            return self._store(entry, x, y)
+
+    def setFit(self, path, background, fit):
+        """ Store the background and the fit (parameters, coefficients, iterations, info) of a spectrum
+
+        The background is dropped if the data have been released meanwhile.
+        """
+        with self._lock:
+            entry = self._spectra.get(path)
+            if entry is None:
+                return
+            entry.fit = fit
+            if entry.loaded():
+                entry.background = background
+                self.evict()
+
+    def evict(self):
+        """ Release the least recently used spectra while the loaded ones exceed maxBytes
+        """
+        with self._lock:
+            size = sum(self._spectra[path].nbytes() for path in self._used)
+            for path in list(self._used):
+                if size <= self.maxBytes:
+                    break
+                if path == self.pinned:
+                    continue
+                entry = self._spectra[path]
+                size -= entry.nbytes()
+                entry.release()
+                del self._used[path]
+
+    def stats(self):
+        with self._lock:
+            return {'spectra': len(self._spectra),
+                    'loaded': len(self._used),
+                    'fitted': sum(e.fit is not None for e in self._spectra.values()),
+                    'bytes': sum(self._spectra[path].nbytes() for path in self._used),
+                    'max_bytes': self.maxBytes,
+                    'loads': self.loads}
+
+    def _store(self, entry, x, y):
+        entry.x = np.asarray(x, dtype=float)
+        entry.y = np.asarray(y, dtype=float)
+        entry.index = np.argsort(entry.x, kind='mergesort')
+        if entry.fit is not None:
+            parameters, coefficients, iterations, info = entry.fit
+            model = 'pspline' if info['solver'] == 'pspline' else 'polynomial'
+            entry.background = backcor.evaluate(entry.x, coefficients, info['xlim'], info['ylim'],
+                                                info['solver'], model)
+        self._used[entry.path] = True
+        # a spectrum larger than maxBytes is released at once, but still returned
+        data = entry.x, entry.y
+        self.evict()
+        return data